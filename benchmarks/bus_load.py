@@ -0,0 +1,168 @@
+"""
+Load test for sharing rooms between server workers (see bus.py and server.on_bus_message).
+
+Starts a broker and N worker processes running the server's own bus handling: each worker handles
+messages with server.on_bus_message and sends frames with server.flush_frames_loop, like
+server.run_worker does. A publisher then sends touch_move and update_state events to a number of
+rooms as fast as it can, like the workers that the rooms' clients are connected to would. Reports
+how many events per second the workers get through as N grows, with the total number of clients
+fixed, and the CPU time that the busiest worker spent per event.
+
+There are no real clients: each worker is told which clients it has in each room, and the events
+it emits go to socketio rooms with nobody in them. So the numbers include everything the server
+does for an event except writing it to each client's socket.
+
+Clients are spread across the workers at random, like SO_REUSEPORT spreads connections, so most
+rooms have clients on several workers, each of which has to relay the room's events. With
+--affine, every client is connected to the worker that owns its room instead, which is the best
+that a load balancer that knows about rooms could do.
+
+On a machine with fewer cores than workers, the workers take turns on the same cores, so the
+event rate can't go up as workers are added. The busiest worker's CPU time per event is what
+bounds the rate once every worker has a core of its own.
+
+usage: python benchmarks/bus_load.py [events] [clients] [rooms] [max workers] [--affine]
+"""
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bus import BrokerBus, owner_index, run_broker
+
+bus_path = '/tmp/interval-bus-load.sock'
+
+def run_worker(index, worker_count, rooms, local_clients, connected, go, ready, results):
+    """
+    :param local_clients: ids of this worker's clients in each room, keyed by room name
+    """
+    import eventlet
+    import server
+
+    server.worker_index, server.worker_count = index, worker_count
+    server.bus = BrokerBus(bus_path, index)
+    server.bus.subscribe(server.on_bus_message)
+
+    # clients only join once every worker is connected, so that owners see every join
+    connected.put(index)
+    go.get()
+
+    # the publisher ends each room with bench_end. the owner answers it with bench_done once it
+    # has published everything it had to, which is what workers relaying the room wait for.
+    waiting = {
+        name: 'bench_done' if name in local_clients else 'bench_end'
+        for name in rooms if name in local_clients or server.is_owner(name)
+    }
+    done = eventlet.Event()
+
+    def on_message(message):
+        name, event = message['room'], message['event']
+        if event == 'bench_end' and server.is_owner(name):
+            server.bus.publish({'room': name, 'event': 'bench_done', 'data': {}})
+        if waiting.get(name) == event:
+            del waiting[name]
+            if not waiting:
+                done.send(time.process_time())
+
+    server.bus.subscribe(on_message)
+    eventlet.spawn(server.bus.listen)
+    eventlet.spawn(server.flush_frames_loop)
+
+    # connect this worker's clients, like server.connect does
+    for name, cids in local_clients.items():
+        for cid in cids:
+            server.client_rooms[cid] = name
+            server.local_client_counts[name] += 1
+            if server.local_client_counts[name] == 1 and not server.is_owner(name):
+                server.bus.watch(name)
+            data = {'cid': cid, 'physics': 'local', 'epoch': time.time()}
+            server.bus.publish({'room': name, 'event': 'join', 'data': data})
+    eventlet.sleep(0.5)
+    start = time.process_time()
+    ready.put(index)
+    end = done.wait() if waiting else start
+    results.put((time.time(), end - start))
+
+def run_trial(worker_count, client_count, room_count, event_count, affine):
+    context = multiprocessing.get_context('fork')
+    if os.path.exists(bus_path):
+        os.remove(bus_path)
+    broker = context.Process(target=run_broker, args=(bus_path, worker_count), daemon=True)
+    broker.start()
+    while not os.path.exists(bus_path):
+        time.sleep(0.01)
+
+    rooms = ['room{}'.format(i) for i in range(room_count)]
+    local_clients = [{} for _ in range(worker_count)]
+    rng = random.Random(0)
+    for i in range(client_count):
+        name = rooms[i % room_count]
+        index = owner_index(name, worker_count) if affine else rng.randrange(worker_count)
+        local_clients[index].setdefault(name, []).append('client{}'.format(i))
+
+    connected, go = context.SimpleQueue(), context.SimpleQueue()
+    ready, results = context.SimpleQueue(), context.SimpleQueue()
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(i, worker_count, rooms, local_clients[i], connected, go, ready, results),
+            daemon=True
+        )
+        for i in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        connected.get()
+    for _ in workers:
+        go.put(True)
+    for _ in workers:
+        ready.get()
+
+    publisher = BrokerBus(bus_path)
+    move = {'cid': 'client0', 'module': 'PhysicsBubble', 'pos': (0.25, 0.75)}
+    update = {
+        'cid': 'client0', 'module': 'PhysicsBubble', 'post': True,
+        'deltas': [['client0', 'pitch', 60]]
+    }
+    start = time.time()
+    for i in range(event_count):
+        name = rooms[i % room_count]
+        if i // room_count % 4:
+            publisher.publish({'room': name, 'event': 'touch_move', 'data': move})
+        else:
+            publisher.publish({'room': name, 'event': 'update_state', 'data': update})
+    for name in rooms:
+        publisher.publish({'room': name, 'event': 'bench_end', 'data': {}})
+    worker_results = [results.get() for _ in workers]
+    end = max(end for end, cpu in worker_results)
+    cpu = max(cpu for end, cpu in worker_results)
+
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+    broker.terminate()
+    broker.join()
+    return event_count / (end - start), cpu / event_count
+
+if __name__ == '__main__':
+    affine = '--affine' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--affine']
+    event_count = int(args[0]) if len(args) > 0 else 20000
+    client_count = int(args[1]) if len(args) > 1 else 240
+    room_count = int(args[2]) if len(args) > 2 else 60
+    max_workers = int(args[3]) if len(args) > 3 else max(os.cpu_count(), 4)
+
+    print('{} events, {} clients in {} rooms, {} cpus{}'.format(
+        event_count, client_count, room_count, os.cpu_count(), ', affine' if affine else ''
+    ))
+    baseline = None
+    worker_count = 1
+    while worker_count <= max_workers:
+        rate, cpu = run_trial(worker_count, client_count, room_count, event_count, affine)
+        baseline = baseline or cpu
+        print('{} worker(s): {:8.0f} events/s, {:6.1f} us cpu/event on the busiest worker '
+              '({:.2f}x capacity)'.format(worker_count, rate, 1e6 * cpu, baseline / cpu))
+        worker_count *= 2
@@ -0,0 +1,88 @@
+"""
+Compares the JSON encoding of hot events with the compact encoding (see protocol.CompactCodec):
+bytes per event, and encode + decode time per event.
+
+Byte counts are given for the event payload alone and for the whole socketio packet. Binary
+socketio events carry a small JSON header naming the event next to the binary attachment.
+
+Also compares sending a tick's worth of touch_move events from several dragging clients as
+separate packets against sending them as one frame.
+
+usage: python benchmarks/wire_encoding.py [iterations] [events per frame]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from protocol import CompactCodec, pack_json_frame
+
+# socketio client ids are 20 characters long
+cid = 'e3a1f09b7c4d4b2a9f1c'
+events = [
+    ('touch_move', {'cid': cid, 'module': 'PhysicsBubble', 'pos': (0.4172, 0.8833)}),
+    ('touch_down', {'cid': cid, 'module': 'SoundBlock', 'pos': (0.1024, 0.5561)}),
+    ('key_down', {'cid': cid, 'module': 'PhysicsBubble', 'key': 'right'})
+]
+
+def json_packet(event, data):
+    return '42' + json.dumps([event, data])
+
+def compact_packet(codec, event, data):
+    header = '451-' + json.dumps(['compact', {'_placeholder': True, 'num': 0}])
+    return header, codec.encode(event, data)
+
+def compare_frames(codec, frame_size):
+    cids = ['{:020d}'.format(i) for i in range(frame_size)]
+    codec.set_peers({c: i for i, c in enumerate(cids)})
+    events = [
+        ('touch_move', {'cid': c, 'module': 'PhysicsBubble', 'pos': (0.4172, 0.8833)})
+        for c in cids
+    ]
+
+    header, _ = compact_packet(codec, *events[0])
+    separate_json = sum(len(json_packet(event, data)) for event, data in events)
+    separate_compact = sum(
+        len(header) + 1 + len(codec.encode(event, data)) for event, data in events
+    )
+    frame_json = len('42' + json.dumps(['frame', pack_json_frame(1, events)]))
+    frame_compact = len(header) + 1 + len(codec.encode_frame(1, events))
+
+    print('\n{} touch_move events from {} clients in one tick'.format(frame_size, frame_size))
+    print('{:<22}{:>10}{:>16}'.format('', 'packets', 'bytes/event'))
+    print('{:<22}{:>10}{:>16.1f}'.format('separate json', frame_size, separate_json / frame_size))
+    print('{:<22}{:>10}{:>16.1f}'.format(
+        'separate compact', frame_size, separate_compact / frame_size
+    ))
+    print('{:<22}{:>10}{:>16.1f}'.format('json frame', 1, frame_json / frame_size))
+    print('{:<22}{:>10}{:>16.1f}'.format('compact frame', 1, frame_compact / frame_size))
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    codec = CompactCodec()
+    codec.set_peers({cid: 3})
+
+    print('{:<12}{:>14}{:>14}{:>14}{:>14}{:>12}{:>12}'.format(
+        'event', 'json bytes', 'json packet', 'compact', 'compact pkt', 'json us', 'compact us'
+    ))
+    for event, data in events:
+        json_bytes = len(json.dumps([event, data]))
+        json_packet_bytes = len(json_packet(event, data))
+        compact_bytes = len(codec.encode(event, data))
+        header, payload = compact_packet(codec, event, data)
+        compact_packet_bytes = len(header) + 1 + len(payload) # +1 for the binary frame type
+
+        json_time = timeit.timeit(
+            lambda: json.loads(json.dumps([event, data])), number=iterations
+        )
+        compact_time = timeit.timeit(
+            lambda: codec.decode(codec.encode(event, data)), number=iterations
+        )
+        print('{:<12}{:>14}{:>14}{:>14}{:>14}{:>12.2f}{:>12.2f}'.format(
+            event, json_bytes, json_packet_bytes, compact_bytes, compact_packet_bytes,
+            1e6 * json_time / iterations, 1e6 * compact_time / iterations
+        ))
+
+    compare_frames(codec, frame_size)
@@ -0,0 +1,205 @@
+"""
+Message buses that relay room events between server workers.
+
+Every room is owned by one worker (see owner_index), which keeps the room's state and decides
+everything about it. Workers publish the events their clients send to the room's topic, and the
+bus delivers each message to the room's owner and to every worker watching the room, i.e. every
+worker with clients in it, in the same order. Other workers never see the room's messages, so
+each worker only does work for the rooms it owns or has clients in.
+
+InProcessBus is used when there is a single worker, which owns every room. BrokerBus connects a
+worker to a broker process (see run_broker) over a Unix socket, for running several workers on
+one machine.
+"""
+import hashlib
+import os
+import pickle
+import socket
+import struct
+import threading
+
+# kinds of frames sent to the broker. workers say hello with their index once connected, and
+# watch and unwatch rooms as their clients come and go.
+publish_frame = 0
+watch_frame = 1
+unwatch_frame = 2
+hello_frame = 3
+
+frame_header = struct.Struct('!IBH') # length of the rest of the frame, kind, length of the topic
+
+def owner_index(name, worker_count):
+    """Returns the index of the worker that owns the room with the given name."""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % worker_count
+
+class InProcessBus(object):
+    """Delivers each published message straight to this process's subscribers."""
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def publish(self, message):
+        for callback in self.callbacks:
+            callback(message)
+
+    def watch(self, topic):
+        """Nothing to watch, since this process owns every room."""
+        pass
+
+    def unwatch(self, topic):
+        pass
+
+    def listen(self):
+        """Nothing to listen to, since publish() already delivers every message."""
+        pass
+
+class BrokerBus(object):
+    """
+    Sends published messages to a broker, which relays them to the owner of their room and to the
+    workers watching it. Messages are only delivered by listen(), which should run in a background
+    task.
+    """
+    def __init__(self, path, index=None):
+        """
+        :param path: path of the broker's Unix socket
+        :param index: this worker's index, so that the broker can send it the rooms it owns. None
+            for processes that only publish.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        self.callbacks = []
+        if index is not None:
+            self.send(hello_frame, str(index))
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def send(self, kind, topic, payload=b''):
+        topic = topic.encode('utf-8')
+        length = frame_header.size - 4 + len(topic) + len(payload)
+        header = frame_header.pack(length, kind, len(topic))
+        with self.lock:
+            self.sock.sendall(header + topic + payload)
+
+    def publish(self, message):
+        self.send(publish_frame, message['room'], pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def watch(self, topic):
+        """Start receiving the messages of a room that this worker doesn't own."""
+        self.send(watch_frame, topic)
+
+    def unwatch(self, topic):
+        self.send(unwatch_frame, topic)
+
+    def listen(self):
+        while True:
+            try:
+                frame = recv_frame(self.sock)
+            except ConnectionError:
+                return
+            if frame is None:
+                return
+            kind, topic, payload = parse_frame(frame)
+            message = pickle.loads(payload)
+            for callback in self.callbacks:
+                callback(message)
+
+def parse_frame(frame):
+    """Returns (kind, topic, payload) of a frame, including its header."""
+    _, kind, topic_length = frame_header.unpack_from(frame)
+    topic = frame[frame_header.size:frame_header.size + topic_length].decode('utf-8')
+    return kind, topic, frame[frame_header.size + topic_length:]
+
+def recv_frame(sock):
+    """Returns the next length-prefixed frame from sock, including its header."""
+    header = recv_exactly(sock, 4)
+    if header is None:
+        return None
+    rest = recv_exactly(sock, struct.unpack('!I', header)[0])
+    if rest is None:
+        return None
+    return header + rest
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def run_broker(path, worker_count):
+    """
+    Relays every message received from a worker to the owner of its room and to the workers
+    watching the room, forever. A single lock around each relay gives all of them the same message
+    order.
+    :param path: path of the Unix socket to listen on
+    :param worker_count: number of workers that rooms are spread over (see owner_index)
+    """
+    # bind to a temporary path and move it into place once listening, so that workers waiting
+    # for the path to exist never connect too early
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(tmp_path)
+    listener.listen()
+    os.replace(tmp_path, path)
+
+    workers = {} # connection of each worker, keyed by index
+    watchers = {} # connections watching each room, keyed by room name
+    lock = threading.Lock()
+
+    def relay(conn):
+        while True:
+            frame = recv_frame(conn)
+            if frame is None:
+                break
+            # frames are relayed as-is, only their topic is read
+            kind, topic, _ = parse_frame(frame)
+            with lock:
+                if kind == hello_frame:
+                    workers[int(topic)] = conn
+                elif kind == watch_frame:
+                    if conn not in watchers.setdefault(topic, []):
+                        watchers[topic].append(conn)
+                elif kind == unwatch_frame:
+                    if conn in watchers.get(topic, []):
+                        watchers[topic].remove(conn)
+                        if not watchers[topic]:
+                            del watchers[topic]
+                else:
+                    targets = watchers.get(topic, [])
+                    owner = workers.get(owner_index(topic, worker_count))
+                    if owner is not None and owner not in targets:
+                        owner.sendall(frame)
+                    for target in targets:
+                        target.sendall(frame)
+        with lock:
+            for index in [index for index, other in workers.items() if other is conn]:
+                del workers[index]
+            for topic in list(watchers):
+                watchers[topic] = [other for other in watchers[topic] if other is not conn]
+                if not watchers[topic]:
+                    del watchers[topic]
+        conn.close()
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=relay, args=(conn,), daemon=True).start()
+
+def make_bus(url, index=None):
+    """
+    Create a bus from a BUS_URL setting: '' for InProcessBus, 'unix:///path/to.sock' for BrokerBus.
+    :param index: this worker's index, for BrokerBus
+    """
+    if not url:
+        return InProcessBus()
+    if url.startswith('unix://'):
+        return BrokerBus(url[len('unix://'):], index)
+    raise ValueError('unknown bus url: {}'.format(url))
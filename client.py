@@ -1,7 +1,7 @@
-import sys, os
+import sys, os, time
+from collections import deque
 sys.path.insert(0, os.path.abspath('..'))
 
-import requests
 import socketio
 
 from common.audio import Audio
@@ -19,11 +19,203 @@ from kivy.uix.button import Button
 from modules.bubble import PhysicsBubble, PhysicsBubbleHandler
 from modules.block import SoundBlock, SoundBlockHandler
 from modules.cursor import TempoCursor, TempoCursorHandler
+from protocol import CompactCodec, pack_json_frame, unpack_json_frame, tick_rate
+from protocol import clock_sync_interval, clock_sync_samples, drift_report_interval
 
 server_url = 'http://interval-app.herokuapp.com/'
 
+# usage: python client.py [mac] [lockstep|server] [room]
+# clients only share a sandbox with other clients in the same room. the first client to join a
+# room picks whether bubbles are simulated by each client on its own, by every client in
+# lockstep, or by the server.
+args = sys.argv[1:]
+mode = 'mac' if 'mac' in args else 'pc'
+physics = 'lockstep' if 'lockstep' in args else 'server' if 'server' in args else 'local'
+room_args = [arg for arg in args if arg not in ('mac', 'lockstep', 'server')]
+room = room_args[0] if room_args else 'lobby'
+
+# max number of touch_move events sent per second. moves in between are coalesced so that only
+# the latest position of each touch is sent.
+move_rate = 30
+
+# max number of seconds per frame spent handling events from the network. whatever is left over is
+# handled on the next frame.
+inbound_budget = 0.004
+
+# outgoing events are batched into frames, sent every frame_interval seconds or as soon as
+# max_frame_events events are waiting
+frame_interval = 0.016
+max_frame_events = 32
+
 client = socketio.Client()
-client.connect(server_url)
+
+class FrameSender(object):
+    """
+    Batches outgoing events (see protocol.frame_events) into frames. Module handlers are given a
+    FrameSender in place of the socketio client, since it has the same emit() method.
+    """
+    def __init__(self, client, codec):
+        self.client = client
+        self.codec = codec
+        self.compact = False # whether the server agreed to the compact encoding
+
+        self.events = []
+        self.seq = 0
+        self.last_flush_time = 0
+
+    def emit(self, event, data):
+        self.events.append((event, data))
+        if len(self.events) >= max_frame_events:
+            self.flush()
+
+    def on_update(self):
+        if self.events and time.time() - self.last_flush_time >= frame_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.time()
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        self.seq += 1
+        if self.compact:
+            self.client.emit('compact_frame', self.codec.encode_frame(self.seq, events))
+        else:
+            self.client.emit('frame', pack_json_frame(self.seq, events))
+
+class InboundQueue(object):
+    """
+    Events from the network, waiting to be handled on the Kivy frame loop. socketio callbacks run
+    on the network thread, so they only put events on the queue, and MainScreen.on_update drains
+    it. deque's append and popleft are atomic, so no lock is needed.
+    """
+    def __init__(self, budget):
+        self.events = deque()
+        self.budget = budget
+        self.latency = 0 # smoothed seconds between an event arriving and being handled
+
+    def put(self, handler, data):
+        self.events.append((time.time(), handler, data))
+
+    def depth(self):
+        return len(self.events)
+
+    def drain(self):
+        """Handle queued events in arrival order until the queue is empty or the budget runs out."""
+        start = time.time()
+        while self.events and time.time() - start < self.budget:
+            arrival, handler, data = self.events.popleft()
+            handler(data)
+            self.latency = 0.9 * self.latency + 0.1 * (time.time() - arrival)
+
+inbound = InboundQueue(inbound_budget)
+
+class ClockSync(object):
+    """
+    Estimates the offset between our clock and the server's, NTP-style (see
+    protocol.clock_sync_interval). An exchange that took rtt seconds there and back gives an offset
+    within rtt / 2 of the truth, so the offset of the recent exchange with the shortest round trip
+    is used. How that offset changes over time is our clock's drift relative to the server's.
+    """
+    def __init__(self):
+        self.samples = deque(maxlen=clock_sync_samples) # recent (arrival time, offset, rtt)
+        self.history = deque(maxlen=4 * clock_sync_samples) # (arrival time, best offset so far)
+        self.offset = None # seconds to add to our clock to get the server's
+        self.rtt = None # round trip of the exchange that self.offset came from
+        self.drift = 0 # parts per million that our clock runs fast relative to the server's
+        self.last_ping_time = 0
+        self.last_report_time = time.time()
+
+    def set_server_time(self, server_time):
+        """Take a rough offset from a single message, ignoring its time in flight."""
+        if self.offset is None:
+            self.offset = server_time - time.time()
+
+    def on_update(self):
+        now = time.time()
+        # the first few pings go out quickly, so that the offset is accurate soon after joining
+        interval = clock_sync_interval
+        if len(self.samples) < clock_sync_samples:
+            interval /= clock_sync_samples
+        if now - self.last_ping_time >= interval:
+            self.last_ping_time = now
+            client.emit('clock_ping', {'t0': now})
+
+        if self.rtt is not None and now - self.last_report_time >= drift_report_interval:
+            self.last_report_time = now
+            data = {'cid': client_id, 'error': self.rtt / 2, 'drift': self.drift}
+            sender.emit('clock_report', data)
+
+    def add_sample(self, t0, t1, t2, t3):
+        """
+        :param t0: our time when the ping was sent
+        :param t1: server time when the ping arrived
+        :param t2: server time when the pong was sent
+        :param t3: our time when the pong arrived
+        """
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        rtt = (t3 - t0) - (t2 - t1)
+        self.samples.append((t3, offset, rtt))
+        _, self.offset, self.rtt = min(self.samples, key=lambda sample: sample[2])
+
+        # drift is the least squares slope of the best offset over time
+        self.history.append((t3, self.offset))
+        if len(self.history) > 1:
+            mean_t = sum(t for t, _ in self.history) / len(self.history)
+            mean_offset = sum(offset for _, offset in self.history) / len(self.history)
+            var = sum((t - mean_t) ** 2 for t, _ in self.history)
+            cov = sum((t - mean_t) * (offset - mean_offset) for t, offset in self.history)
+            self.drift = -1e6 * cov / var if var else 0
+
+clock_sync = ClockSync()
+
+class RoomClock(object):
+    """
+    The room's clock, which counts seconds (and physics ticks) from the room's epoch on the
+    server's clock, using the offset that clock_sync estimates.
+    """
+    def __init__(self, epoch, sync):
+        self.epoch = epoch
+        self.sync = sync
+
+    def get_time(self):
+        return time.time() + self.sync.offset - self.epoch
+
+    def get_tick(self):
+        return int(self.get_time() * tick_rate)
+
+# hot events are packed with the compact encoding once the server has agreed to it and assigned us
+# a peer id. these handlers are registered before connecting since the server sends both right away.
+codec = CompactCodec()
+sender = FrameSender(client, codec)
+
+@client.on('encoding')
+def on_encoding(data):
+    sender.compact = data['encoding'] == 'compact'
+
+@client.on('peer_ids')
+def on_peer_ids(data):
+    codec.set_peers(data)
+
+@client.on('room_info')
+def on_room_info(data):
+    # the clock offset is measured on arrival, rather than whenever the frame loop gets to it
+    clock_sync.set_server_time(data['server_time'])
+    room_clock = RoomClock(data['epoch'], clock_sync)
+    inbound.put(set_room_info, dict(data, clock=room_clock))
+
+@client.on('clock_pong')
+def on_clock_pong(data):
+    inbound.put(add_clock_sample, dict(data, t3=time.time()))
+
+def add_clock_sample(data):
+    clock_sync.add_sample(data['t0'], data['t1'], data['t2'], data['t3'])
+
+# websocket only, so that the whole session stays on one server worker
+client.connect(
+    '{}?room={}&enc=compact&physics={}'.format(server_url, room, physics),
+    transports=['websocket']
+)
 register_terminate_func(client.disconnect)
 
 # each client gets a unique client id upon connecting. we use this client id in many
@@ -44,9 +236,13 @@ class MainScreen(Screen):
     def __init__(self, **kwargs):
         super(MainScreen, self).__init__(**kwargs)
 
-        mode = 'mac' if (len(sys.argv) == 2) and (sys.argv[1] == 'mac') else 'pc'
         self.norm = Normalizer(mode)
 
+        # latest unsent touch_move data for each touch, keyed by touch uid
+        self.pending_moves = {}
+        self.last_move_time = 0
+        self.moves_coalesced = 0 # number of touch_move events dropped in favor of a later one
+
         self.info = topleft_label()
         self.add_widget(self.info)
 
@@ -73,15 +269,15 @@ class MainScreen(Screen):
             'TempoCursor': TempoCursor
         }
         block = SoundBlockHandler(
-            self.norm, self.sandbox, self.mixer, client, client_id
+            self.norm, self.sandbox, self.mixer, sender, client_id
         )
         self.module_handlers = {
             'SoundBlock': block,
             'PhysicsBubble': PhysicsBubbleHandler(
-                self.norm, self.sandbox, self.mixer, client, client_id, block
+                self.norm, self.sandbox, self.mixer, sender, client_id, block
             ),
             'TempoCursor': TempoCursorHandler(
-                self.norm, self.sandbox, self.mixer, client, client_id, block
+                self.norm, self.sandbox, self.mixer, sender, client_id, block
             )
         }
 
@@ -94,31 +290,49 @@ class MainScreen(Screen):
         client.emit('sync_module_state', {'module': 'PhysicsBubble'})
         client.emit('sync_module_state', {'module': 'SoundBlock'})
         client.emit('sync_module_state', {'module': 'TempoCursor'})
-        client.emit('update_norm', {'norm': {client_id: self.norm.mode}})
 
     def on_touch_down(self, touch):
         if touch.button != 'left':
             return
 
         global client, client_id
-        data = {'cid': client_id, 'module': self.module.name, 'pos': touch.pos}
-        client.emit('touch_down', data)
+        pos = self.sandbox.to_local(touch.pos)
+        data = {'cid': client_id, 'module': self.module.name, 'pos': pos}
+        self.flush_moves()
+        sender.emit('touch_down', data)
 
     def on_touch_move(self, touch):
         if touch.button != 'left':
             return
 
         global client, client_id
-        data = {'cid': client_id, 'module': self.module.name, 'pos': touch.pos}
-        client.emit('touch_move', data)
+        pos = self.sandbox.to_local(touch.pos)
+        data = {'cid': client_id, 'module': self.module.name, 'pos': pos}
+        if touch.uid in self.pending_moves:
+            self.moves_coalesced += 1
+        self.pending_moves[touch.uid] = data
+
+        if time.time() - self.last_move_time >= 1 / move_rate:
+            self.flush_moves()
 
     def on_touch_up(self, touch):
         if touch.button != 'left':
             return
 
         global client, client_id
-        data = {'cid': client_id, 'module': self.module.name, 'pos': touch.pos}
-        client.emit('touch_up', data)
+        pos = self.sandbox.to_local(touch.pos)
+        data = {'cid': client_id, 'module': self.module.name, 'pos': pos}
+        # send any pending move first so that handlers see the last move before the release
+        self.flush_moves()
+        sender.emit('touch_up', data)
+
+    def flush_moves(self):
+        """Send the latest touch_move of every touch that moved since the last flush."""
+        global sender
+        for data in self.pending_moves.values():
+            sender.emit('touch_move', data)
+        self.pending_moves.clear()
+        self.last_move_time = time.time()
 
     def on_key_down(self, keycode, modifiers):
         global client, client_id
@@ -143,15 +357,29 @@ class MainScreen(Screen):
             self.writer.toggle()
         else:
             data = {'cid': client_id, 'module': self.module.name, 'key': key}
-            client.emit('key_down', data)
+            sender.emit('key_down', data)
 
     def on_update(self):
+        if self.pending_moves and time.time() - self.last_move_time >= 1 / move_rate:
+            self.flush_moves()
+        sender.on_update()
+        clock_sync.on_update()
+        inbound.drain()
+
         self.audio.on_update()
         for _, handler in self.module_handlers.items():
             handler.on_update()
 
         self.info.text = 'module: {}\n\n'.format(self.module.name)
         self.info.text += self.module_handler.display_controls()
+        self.info.text += '\nmoves coalesced: {}\n'.format(self.moves_coalesced)
+        self.info.text += 'inbound queue: {} ({:.1f} ms)\n'.format(
+            inbound.depth(), 1000 * inbound.latency
+        )
+        if clock_sync.rtt is not None:
+            self.info.text += 'clock: +/- {:.1f} ms, drift {:+.1f} ppm\n'.format(
+                500 * clock_sync.rtt, clock_sync.drift
+            )
 
     def on_layout(self, win_size):
         resize_topleft_label(self.info)
@@ -245,63 +473,140 @@ class Sandbox(object):
     def __contains__(self, key):
         return key in self.canvas.children
 
+    def to_local(self, pos):
+        """
+        Convert a pixel position to sandbox-relative (u, v) coordinates, where the sandbox spans
+        0..1 on both axes. positions go over the wire in this form so that clients with any
+        window size can share a room without rescaling.
+        """
+        return ((pos[0] - self.pos[0]) / self.width, (pos[1] - self.pos[1]) / self.height)
+
+    def from_local(self, uv):
+        """Convert sandbox-relative (u, v) coordinates back to this client's pixel space."""
+        return (self.pos[0] + uv[0] * self.width, self.pos[1] + uv[1] * self.height)
+
+# names of modules whose handlers are waiting on a full resync after missing a state delta
+resyncing = set()
+
 @client.on('sync_module_state')
+def on_sync_module_state(data):
+    inbound.put(sync_module_state, data)
+
 def sync_module_state(data):
     module_str = data['module']
     handler = main.module_handlers[module_str]
-    handler.sync_state(data['state'])
+    if data.get('resync'):
+        resyncing.discard(module_str)
+        handler.resync_state(data['state'], data['version'])
+    else:
+        handler.sync_state(data['state'], data['version'])
 
-@client.on('update_state')
 def update_client_state(data):
-    module_str, state, cid = data['module'], data['state'], data['cid']
+    module_str, deltas, cid, version = data['module'], data['deltas'], data['cid'], data['version']
     handler = main.module_handlers[module_str]
-    handler.update_client_state(cid, state)
 
-@client.on('touch_down')
+    # deltas are versioned per module. anything at or below our version is already reflected in
+    # our state (including deltas sent before our initial sync), and a jump of more than one means
+    # we missed a delta, so we ask the server for its whole copy of the module state instead.
+    if handler.version is None or version <= handler.version or module_str in resyncing:
+        return
+    if version > handler.version + 1:
+        resyncing.add(module_str)
+        client.emit('sync_module_state', {'module': module_str, 'resync': True})
+        return
+
+    handler.version = version
+    handler.update_client_state(cid, deltas)
+
 def on_touch_down(data):
-    norm = requests.get('{}norms/{}'.format(server_url, data['cid'])).text
-    if main.norm.mode == 'mac' and norm == 'pc':
-        pos = (2 * data['pos'][0], 2 * data['pos'][1])
-    elif main.norm.mode == 'pc' and norm == 'mac':
-        pos = (0.5 * data['pos'][0], 0.5 * data['pos'][1])
-    else:
-        pos = data['pos']
+    pos = main.sandbox.from_local(data['pos'])
     module_str = data['module']
     handler = main.module_handlers[module_str]
     handler.on_touch_down(data['cid'], pos)
 
-@client.on('touch_move')
 def on_touch_move(data):
-    norm = requests.get('{}norms/{}'.format(server_url, data['cid'])).text
-    if main.norm.mode == 'mac' and norm == 'pc':
-        pos = (2 * data['pos'][0], 2 * data['pos'][1])
-    elif main.norm.mode == 'pc' and norm == 'mac':
-        pos = (0.5 * data['pos'][0], 0.5 * data['pos'][1])
-    else:
-        pos = data['pos']
+    pos = main.sandbox.from_local(data['pos'])
     module_str = data['module']
     handler = main.module_handlers[module_str]
     handler.on_touch_move(data['cid'], pos)
 
-@client.on('touch_up')
 def on_touch_up(data):
-    norm = requests.get('{}norms/{}'.format(server_url, data['cid'])).text
-    if main.norm.mode == 'mac' and norm == 'pc':
-        pos = (2 * data['pos'][0], 2 * data['pos'][1])
-    elif main.norm.mode == 'pc' and norm == 'mac':
-        pos = (0.5 * data['pos'][0], 0.5 * data['pos'][1])
-    else:
-        pos = data['pos']
+    pos = main.sandbox.from_local(data['pos'])
     module_str = data['module']
     handler = main.module_handlers[module_str]
-    handler.on_touch_up(data['cid'], pos)
+    if 'tick' in data and module_str == 'PhysicsBubble': # see PhysicsBubbleHandler.on_touch_up
+        handler.on_touch_up(data['cid'], pos, tick=data['tick'])
+    else:
+        handler.on_touch_up(data['cid'], pos)
 
-@client.on('key_down')
 def on_key_down(data):
     module_str = data['module']
     handler = main.module_handlers[module_str]
     handler.on_key_down(data['cid'], data['key'])
 
+def set_room_info(data):
+    main.module_handlers['TempoCursor'].set_room_clock(data['clock'])
+    if data['physics'] == 'lockstep':
+        main.module_handlers['PhysicsBubble'].set_lockstep(data['clock'])
+    elif data['physics'] == 'server':
+        main.module_handlers['PhysicsBubble'].set_server_physics(data['clock'], data['bubbles'])
+
+@client.on('snapshot_request')
+def on_snapshot_request(data):
+    inbound.put(send_snapshot, data)
+
+def send_snapshot(data):
+    main.module_handlers['PhysicsBubble'].send_snapshot()
+
+@client.on('snapshot')
+def on_snapshot(data):
+    inbound.put(restore_snapshot, data)
+
+def restore_snapshot(data):
+    main.module_handlers['PhysicsBubble'].restore_snapshot(data)
+
+@client.on('bubble_snapshot')
+def on_bubble_snapshot(packet):
+    inbound.put(add_bubble_snapshot, packet)
+
+def add_bubble_snapshot(packet):
+    main.module_handlers['PhysicsBubble'].add_snapshot(packet)
+
+def on_bubble_spawn(data):
+    main.module_handlers['PhysicsBubble'].add_streamed(data)
+
+def on_bubble_hit(data):
+    main.module_handlers['PhysicsBubble'].on_bubble_hit(data)
+
+@client.on('frame')
+def on_frame(frame):
+    """
+    Queues a frame of events from the server, in order. The websocket already delivers frames in
+    order and exactly once, so sequence numbers aren't checked. They count per worker and room, so
+    they start over when the room does or when this client reconnects to another worker.
+    """
+    seq, events = unpack_json_frame(frame)
+    queue_events(events)
+
+@client.on('compact_frame')
+def on_compact_frame(packet):
+    seq, events = codec.decode_frame(packet)
+    queue_events(events)
+
+def queue_events(events):
+    for event, data in events:
+        inbound.put(frame_handlers[event], data)
+
+frame_handlers = {
+    'touch_down': on_touch_down,
+    'touch_move': on_touch_move,
+    'touch_up': on_touch_up,
+    'key_down': on_key_down,
+    'update_state': update_client_state,
+    'bubble_spawn': on_bubble_spawn,
+    'bubble_hit': on_bubble_hit
+}
+
 if __name__ == "__main__":
     sm = ScreenManager()
     start = StartScreen(name='start')
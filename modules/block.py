@@ -15,7 +15,10 @@ from common.clock import Clock, SimpleTempoMap, Scheduler, AudioScheduler, tick_
 
 import numpy as np
 
+from protocol import client_deltas, apply_deltas, keep_client_entries
 from modules.block_gui import BlockGUI, InstrumentSelect
+from modules.physics import BlockGrid
+from modules.block_mesh import BlockMesh
 
 def in_bounds(mouse_pos, obj_pos, obj_size):
     """
@@ -29,15 +32,17 @@ def in_bounds(mouse_pos, obj_pos, obj_size):
            (mouse_pos[1] >= obj_pos[1]) and \
            (mouse_pos[1] <= obj_pos[1] + obj_size[1])
 
-class SoundBlock(InstructionGroup):
+class SoundBlock(object):
     """
     This module is a rectangular, static block that plays a sound when either someone clicks it,
     or another sound module (e.g. PhysicsBubble) collides with it.
+
+    Every block is drawn by its handler's BlockMesh, so this class only keeps the block's bounds
+    and sound.
     """
     name = 'SoundBlock'
 
     def __init__(self, norm, sandbox, pos, size, channel, pitch, color, handler, callback=None):
-        super(SoundBlock, self).__init__()
         self.norm = norm
         self.sandbox = sandbox
         self.pos = np.array(pos, dtype=np.float)
@@ -45,41 +50,17 @@ class SoundBlock(InstructionGroup):
         self.handler = handler
         self.callback = callback
 
-        self.rect = Rectangle(
-            pos=self.pos,
-            size=self.size,
-        )
-        self.white = (239/255, 226/255, 222/255)
-        self.color = Color(*self.white)
-        self.add(self.color)
-        self.add(self.rect)
-
         self.channel = channel
         self.pitch = pitch
         self.hit_color = color
 
-        self.add(Color(*self.hit_color))
-        self.border = Line(rectangle=(*self.pos, *self.size), width=2)
-        self.add(self.border)
-
-        self.hit = False
-        self.flash_anim = KFAnim((0, *self.hit_color), (.5, *self.white))
-
-        self.time = 0
-
-    def flash(self):
-        self.callback(self.channel, self.pitch)
-        self.time = 0
-        self.hit = True
-
-    def on_update(self, dt):
-        if self.hit:
-            rgb = self.flash_anim.eval(self.time)
-            self.color.rgb = rgb
-            self.time += dt
-            if not self.flash_anim.is_active(self.time):
-                self.hit = False
-                self.time = 0
+    def flash(self, delay=None):
+        """
+        :param delay: seconds from now on the audio clock at which the sound starts, or None to
+            play it immediately
+        """
+        self.callback(self.channel, self.pitch, delay)
+        self.handler.mesh.flash(self)
 
 class SoundBlockHandler(object):
     """
@@ -155,10 +136,24 @@ class SoundBlockHandler(object):
         self.instrument = {}
         self.drum = {}
 
+        # version of the last state delta applied from the server, or None before initial sync.
+        # self.sent holds this client's field values as of its last update to the server.
+        self.version = None
+        self.sent = {}
+
         self.display = False
 
-        self.blocks = AnimGroup()
-        self.sandbox.add(self.blocks)
+        # every block is drawn by one BlockMesh, which only updates the blocks that are flashing
+        self.blocks = []
+        self.mesh = BlockMesh()
+        self.sandbox.add(self.mesh)
+
+        # spatial index of self.blocks for bubble collisions, updated as blocks are added/deleted
+        self.grid = BlockGrid()
+
+        # callbacks of the form callback(block, added) that are called whenever a block is added
+        # or deleted, e.g. for TempoCursors to keep track of the blocks under them
+        self.block_listeners = []
 
         self.gui = BlockGUI(
             self.norm,
@@ -179,11 +174,14 @@ class SoundBlockHandler(object):
             return
 
         # when a block is clicked, flash and play a sound
-        for block in self.blocks.objects:
+        for block in self.blocks:
             if in_bounds(pos, block.pos, block.size):
                 if self.delete_mode[cid]:
-                    self.blocks.objects.remove(block)
                     self.blocks.remove(block)
+                    self.mesh.remove_block(block)
+                    self.grid.remove(block)
+                    for callback in self.block_listeners:
+                        callback(block, False)
                     return
 
                 block.flash()
@@ -265,7 +263,11 @@ class SoundBlockHandler(object):
                 self.norm, self.sandbox, bottom_left, size, self.channel,
                 pitch, color, self, self.sound
             )
-        self.blocks.add(block)
+        self.blocks.append(block)
+        self.mesh.add_block(block)
+        self.grid.insert(block)
+        for callback in self.block_listeners:
+            callback(block, True)
 
     def on_key_down(self, cid, key):
         index = lookup(key, 'q2w3er5t6y7ui', range(13))
@@ -315,14 +317,14 @@ class SoundBlockHandler(object):
         return info
 
     def on_update(self):
-        self.blocks.on_update()
+        self.mesh.on_update(kivyClock.frametime)
         self.gui.on_update(Window.mouse_pos)
 
-    def update_server_state(self, post=False):
+    def get_state(self):
         """
-        Update server state. If post is True, relay this updated state to all clients.
+        Returns this module's syncable state, keyed by field.
         """
-        state = {
+        return {
             'color': self.color,
             'pitch': self.pitch,
             'timbre': self.timbre,
@@ -330,33 +332,49 @@ class SoundBlockHandler(object):
             'drum': self.drum,
             'delete_mode': self.delete_mode
         }
-        data = {'module': self.module_name, 'cid': self.cid, 'state': state, 'post': post}
+
+    def set_state(self, state):
+        self.color = state['color']
+        self.pitch = state['pitch']
+        self.timbre = state['timbre']
+        self.instrument = state['instrument']
+        self.drum = state['drum']
+        self.delete_mode = state['delete_mode']
+
+    def update_server_state(self, post=False):
+        """
+        Send the fields of this client's state that changed since the last update to the server.
+        If post is True, relay the changes to all clients.
+        """
+        deltas = client_deltas(self.cid, self.get_state(), self.sent)
+        if not deltas:
+            return
+        data = {'module': self.module_name, 'cid': self.cid, 'deltas': deltas, 'post': post}
         self.client.emit('update_state', data)
 
-    def update_client_state(self, cid, state):
+    def update_client_state(self, cid, deltas):
         """
-        Update this handler's state.
+        Apply another client's state deltas to this handler's state.
         """
         if cid != self.cid: # this client already updated its own state
-            self.color = state['color']
-            self.pitch = state['pitch']
-            self.timbre = state['timbre']
-            self.instrument = state['instrument']
-            self.drum = state['drum']
-            self.delete_mode = state['delete_mode']
-
-    def sync_state(self, state):
+            apply_deltas(self.get_state(), deltas, self.sent)
+
+    def resync_state(self, state, version):
+        """
+        Replace this handler's state with the server's copy after missing a delta.
+        """
+        keep_client_entries(state, self.get_state(), self.cid)
+        self.set_state(state)
+        self.version = version
+
+    def sync_state(self, state, version):
         """
         Initial sync with the server's copy of module state.
         We don't sync with hold_shape, hold_point, and hold_line because those objects are not
         json-serializable and are short-term values anyway.
         """
-        self.color = state['color']
-        self.pitch = state['pitch']
-        self.timbre = state['timbre']
-        self.instrument = state['instrument']
-        self.drum = state['drum']
-        self.delete_mode = state['delete_mode']
+        self.set_state(state)
+        self.version = version
 
         # after initial sync, add default values for this client
         self.color[self.cid] = self.default_color
@@ -376,15 +394,22 @@ class SoundBlockHandler(object):
         # default values.
         self.update_server_state(post=True)
 
-    def sound(self, channel, pitch):
+    def sound(self, channel, pitch, delay=None):
         """
         Play a sound with a given pitch on the given channel.
+        :param delay: seconds from now on the audio clock at which the note starts, or None to
+            play it immediately. delayed notes are started by the audio scheduler on the exact
+            audio frame.
         """
         if self.cmd.get((channel, pitch)):
             self.sched.cancel(self.cmd[(channel, pitch)])
-        self.synth.noteon(channel, pitch, 100)
-        now = self.sched.get_tick()
-        self.cmd[(channel, pitch)] = self.sched.post_at_tick(self._noteoff, now + 240, (channel, pitch))
+        if delay is None:
+            self.synth.noteon(channel, pitch, 100)
+            start = self.sched.get_tick()
+        else:
+            start = self.tempo_map.time_to_tick(self.sched.get_time() + max(delay, 0))
+            self.sched.post_at_tick(self._noteon, start, (channel, pitch))
+        self.cmd[(channel, pitch)] = self.sched.post_at_tick(self._noteoff, start + 240, (channel, pitch))
 
     def update_pitch(self, color, pitch):
         """Update this client's color and pitch due to PitchSelect."""
@@ -404,6 +429,10 @@ class SoundBlockHandler(object):
         self.drum_channel = self.drum_list.index(drum)+len(self.inst_list)
         self.update_server_state(post=True)
 
+    def _noteon(self, tick, args):
+        channel, pitch = args
+        self.synth.noteon(channel, pitch, 100)
+
     def _noteoff(self, tick, args):
         channel, pitch = args
         self.synth.noteoff(channel, pitch)
@@ -0,0 +1,93 @@
+from kivy.graphics import RenderContext
+
+import numpy as np
+
+from modules.bubble_mesh import MeshBatch, vertex_shader, fragment_shader
+
+white = (239/255, 226/255, 222/255)
+border_width = 2
+flash_duration = 0.5 # seconds for a flashing block to fade from its color back to white
+
+# each block is 12 vertices: the 4 corners of its fill, then the 4 outer and 4 inner corners of its
+# border, all counterclockwise from the bottom left
+fill_indices = [0, 1, 2, 0, 2, 3]
+border_indices = []
+for side in range(4):
+    outer, next_outer = 4 + side, 4 + (side + 1) % 4
+    inner, next_inner = 8 + side, 8 + (side + 1) % 4
+    border_indices += [outer, next_outer, next_inner, outer, next_inner, inner]
+block_indices = np.array(fill_indices + border_indices)
+
+def corners(pos, size, margin=0):
+    """Returns the corners of a rectangle grown by margin, counterclockwise from the bottom left."""
+    left, bottom = pos[0] - margin, pos[1] - margin
+    right, top = pos[0] + size[0] + margin, pos[1] + size[1] + margin
+    return np.array(((left, bottom), (right, bottom), (right, top), (left, top)))
+
+class BlockMesh(RenderContext):
+    """
+    Draws every SoundBlock in one vertex buffer, in the order that they were added. Each frame, only
+    the fill colors of blocks that are flashing are updated, so idle blocks cost nothing to draw.
+    """
+    def __init__(self):
+        super(BlockMesh, self).__init__(use_parent_projection=True, use_parent_modelview=True)
+        self.shader.vs = vertex_shader
+        self.shader.fs = fragment_shader
+
+        self.batch = MeshBatch(self, 12, block_indices)
+        self.rows = {} # row of each block in the arrays below, keyed by block
+        self.blocks = [] # blocks in row order
+        self.vertices = np.zeros((0, 12, 8))
+        self.hit_color = np.zeros((0, 3))
+        self.flash_time = np.zeros(0)
+        self.flashing = np.zeros(0, dtype=bool)
+
+    def add_block(self, block):
+        vertices = np.zeros((1, 12, 8))
+        vertices[0, :4, :2] = corners(block.pos, block.size)
+        vertices[0, 4:8, :2] = corners(block.pos, block.size, border_width)
+        vertices[0, 8:, :2] = corners(block.pos, block.size, -border_width)
+        vertices[0, :4, 4:] = (*white, 1)
+        vertices[0, 4:, 4:] = (*block.hit_color, 1)
+
+        self.rows[block] = len(self.blocks)
+        self.blocks.append(block)
+        self.vertices = np.concatenate((self.vertices, vertices))
+        self.hit_color = np.concatenate((self.hit_color, [block.hit_color]))
+        self.flash_time = np.append(self.flash_time, 0)
+        self.flashing = np.append(self.flashing, False)
+        self.batch.upload(self.vertices, [len(self.blocks) - 1])
+
+    def remove_block(self, block):
+        row = self.rows.pop(block)
+        del self.blocks[row]
+        for other in self.blocks[row:]:
+            self.rows[other] -= 1
+        self.vertices = np.delete(self.vertices, row, axis=0)
+        self.hit_color = np.delete(self.hit_color, row, axis=0)
+        self.flash_time = np.delete(self.flash_time, row)
+        self.flashing = np.delete(self.flashing, row)
+        self.batch.upload(self.vertices)
+
+    def flash(self, block):
+        """Flash a block with its color, fading back to white."""
+        row = self.rows[block]
+        self.flash_time[row] = 0
+        self.flashing[row] = True
+
+    def on_update(self, dt):
+        if not self.flashing.any():
+            return
+
+        rows = np.flatnonzero(self.flashing)
+        t = np.minimum(self.flash_time[rows] / flash_duration, 1)[:, None]
+        rgb = self.hit_color[rows] * (1 - t) + np.array(white) * t
+        self.flash_time[rows] += dt
+
+        # blocks that are done flashing go back to exactly white
+        done = self.flash_time[rows] >= flash_duration
+        rgb[done] = white
+        self.flashing[rows[done]] = False
+
+        self.vertices[rows, :4, 4:7] = rgb[:, None]
+        self.batch.upload(self.vertices, rows)
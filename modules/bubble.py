@@ -2,8 +2,10 @@ import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 
 from common.core import lookup
-from common.gfxutil import topleft_label, CEllipse, CRectangle, CLabelRect, AnimGroup, KFAnim
+from common.gfxutil import topleft_label, CEllipse, CRectangle
 from common.note import NoteGenerator, Envelope
+from common.mixer import Mixer
+from common.clock import SimpleTempoMap, AudioScheduler
 from kivy.graphics import Color, Line, Rectangle
 from kivy.graphics.instructions import InstructionGroup
 from kivy.core.image import Image
@@ -11,28 +13,54 @@ from kivy.core.window import Window
 from kivy.clock import Clock as kivyClock
 
 import numpy as np
-import requests
+
+from protocol import client_deltas, apply_deltas, keep_client_entries, hash_interval
+from protocol import decode_snapshot, tick_rate, interp_delay
 
 from modules.bubble_gui import TimbreSelect, GravitySelect, BounceSelect, PitchSelect
 from modules.bubble_gui import BubbleGUI
+from modules.physics import BubbleWorld, step_size
+from modules.labels import LabelCache, CachedLabel
+from modules.bubble_mesh import BubbleMesh, fade_duration
+
+# collision sounds are scheduled on the audio clock this many seconds after their impact time, so
+# that impacts anywhere within a frame can still be played with their exact spacing. this must be
+# longer than a frame, or late impacts are played as soon as possible instead.
+sound_lookahead = 0.05
+
+# in lockstep, at most lockstep_catchup ticks are simulated per frame to catch up with the room, and
+# releases from the last spawn_history ticks are kept to be replayed after a snapshot
+lockstep_catchup = 30
+spawn_history = 240
+
+# in lockstep, the world removes bubbles this many ticks after they run out of bounces, which is
+# long enough for them to fade away
+lockstep_expire_ticks = int(np.ceil(fade_duration * tick_rate))
 
-downwards_gravity = np.array((0, -1800))
-damping_factor = 0.85
+# finished slingshot previews are reused rather than reallocated, keeping at most pool_size per
+# timbre
+pool_size = 32
 
-class PhysicsBubble(InstructionGroup):
+# bounce counts from 0 up to this are rendered into the handler's label cache on startup
+prerendered_bounces = 20
+
+class PhysicsBubble(object):
     """
     This module is a drag-and-release physics-based bubble that plays a sound upon colliding with
     another collidable object, including the sandbox edges.
+
+    The bubble's physics state lives in a slot of the handler's BubbleWorld, and every bubble is
+    drawn by the handler's BubbleMesh, so this class only keeps the bubble's sound and settings.
     """
     name = 'PhysicsBubble'
 
     def __init__(
-        self, norm, sandbox, pos, vel, pitch, timbre, color, bounces, handler,
-        gravity=False, callback=None
+        self, norm, world, mesh, pos, vel, pitch, timbre, color, bounces, gravity=False
     ):
         """
         :param norm: normalizer
-        :param sandbox: client's sandbox
+        :param world: the BubbleWorld that simulates this bubble
+        :param mesh: the BubbleMesh that draws this bubble
         :param pos: initial position
         :param vel: initial velocity
         :param pitch: MIDI pitch value, where 60 is middle C
@@ -40,175 +68,94 @@ class PhysicsBubble(InstructionGroup):
         :param color: 3-tuple of RGB color
         :param bounces: number of times the bubble bounces before fading away
         :param gravity: whether or not the bubble is subjected to downwards gravity
-        :param callback: the sound function that is called when the bubble bounces
         """
-        super(PhysicsBubble, self).__init__()
-
-        self.norm = norm
-        self.sandbox = sandbox
+        self.world = world
+        self.mesh = mesh
 
-        self.r = self.norm.nv(40)
-        self.pos = np.array(pos, dtype=np.float)
-        self.vel = 2 * np.array(vel, dtype=np.float)
+        self.r = norm.nv(40)
+        self.timbre = timbre
+        self.slot = self.world.add(pos, 2 * np.array(vel, dtype=float), self.r, bounces, gravity)
+        self.mesh.show(self.slot, self.timbre, color)
 
         self.pitch = pitch
+        self.color = tuple(color)
+        self.gravity = gravity
+
+class BubblePreview(InstructionGroup):
+    """
+    The slingshot that a client drags out before releasing a PhysicsBubble: a preview of the bubble
+    under the cursor, with a line back to where the drag started.
+    """
+    def __init__(self, labels, shape, timbre, pos, color, bounces):
+        """
+        :param labels: LabelCache of bounce count textures
+        :param shape: the preview's shape, which depends on its timbre
+        :param timbre: type of waveform, e.g. 'sine' or 'sawtooth'
+        :param pos: where the drag started
+        :param color: 3-tuple of RGB color
+        :param bounces: number of bounces shown on the preview
+        """
+        super(BubblePreview, self).__init__()
+
+        self.shape = shape
         self.timbre = timbre
         self.color = Color(*color)
+        self.line = Line(points=(*pos, *pos), width=3)
         self.text_color = Color(0, 0, 0)
         self.bounces = bounces
-        self.gravity = gravity
-        self.callback = callback
-        self.handler = handler
-
-        self.text = CLabelRect(cpos=pos, text=str(self.bounces))
-        self.bubble = self.timbre_to_shape(self.timbre, pos)
+        self.text = CachedLabel(labels, cpos=pos, text=str(self.bounces))
 
         self.add(self.color)
-        self.add(self.bubble)
+        self.add(self.shape)
+        self.add(self.line)
         self.add(self.text_color)
         self.add(self.text)
 
-        # have the bubble fade away when self.bounces = 0
-        self.fade_anim = KFAnim((0, 1), (0.25, 0))
-        self.time = 0
-
-        self.on_update(0)
-
-    def timbre_to_shape(self, timbre, pos):
-        if timbre == 'sine':
-            return CEllipse(cpos=pos, size=self.norm.nt((80, 80)), segments=20)
-        elif timbre == 'triangle':
-            return CEllipse(cpos=pos, size=self.norm.nt((90, 90)), segments=3)
-        elif timbre == 'square':
-            return CRectangle(cpos=pos, size=self.norm.nt((80, 80)))
-        elif timbre == 'sawtooth':
-            # square rotated 45 degrees
-            return CEllipse(cpos=pos, size=self.norm.nt((90, 90)), segments=4)
+        self.reset(pos, color, bounces)
 
-    def on_update(self, dt):
-        if self.gravity:
-            self.vel += downwards_gravity * dt
-            self.pos += self.vel * dt
-        else:
-            self.pos += self.vel * dt
-
-        if self.bounces > 0:
-            if self.check_for_block_collisions() and self.callback is not None:
-                self.callback(self.pitch, self.timbre)
-            if self.check_for_collisions() and self.callback is not None:
-                self.callback(self.pitch, self.timbre)
-        # second condition checks if bubble hasn't been moving but there's no gravity --
-        # since bubble would be on the screen forever without making sound, fade it away
-        if self.bounces <= 0 or (not self.gravity and np.linalg.norm(self.vel) == 0):
-            self.color.a = self.fade_anim.eval(self.time)
-            self.time += dt
-
-        self.bubble.set_cpos(self.pos)
-        self.text.set_cpos(self.pos)
-
-        return self.fade_anim.is_active(self.time)
-
-    def check_for_collisions(self):
-        bottom = self.sandbox.pos[1]
-        top = self.sandbox.pos[1] + self.sandbox.height
-        left = self.sandbox.pos[0]
-        right = self.sandbox.pos[0] + self.sandbox.width
-
-        # collision with bottom
-        if self.pos[1] - self.r < bottom:
-            self.vel[1] = -self.vel[1] * damping_factor if self.gravity else -self.vel[1]
-            self.pos[1] = bottom + self.r
-            self.bounces -= 1
-            self.text.set_text(str(self.bounces))
-            return True
+    def reset(self, pos, color, bounces):
+        """Start a new drag at pos, either when the preview is made or reused from a PreviewPool."""
 
-        # collision with top
-        if self.pos[1] + self.r > top:
-            self.vel[1] = -self.vel[1]
-            self.pos[1] = top - self.r
-            self.bounces -= 1
+        self.color.rgb = color
+        if bounces != self.bounces:
+            self.bounces = bounces
             self.text.set_text(str(self.bounces))
-            return True
+        self.set_cpos(pos, pos)
 
-        # collision with left
-        if self.pos[0] - self.r < left:
-            self.vel[0] = -self.vel[0]
-            self.pos[0] = left + self.r
-            self.bounces -= 1
-            self.text.set_text(str(self.bounces))
-            return True
+    def set_cpos(self, hold_point, pos):
+        self.shape.set_cpos(pos)
+        self.text.set_cpos(pos)
+        self.line.points = (*hold_point, *pos)
 
-        # collision with right
-        if self.pos[0] + self.r > right:
-            self.vel[0] = -self.vel[0]
-            self.pos[0] = right - self.r
-            self.bounces -= 1
-            self.text.set_text(str(self.bounces))
-            return True
-
-    def check_for_block_collisions(self):
-        """Check to see if this bubble collided with any SoundBlocks."""
-        collide = False
-        blocks = self.handler.block_handler.blocks.objects
-        for block in blocks:
-            left_x = block.pos[0]
-            right_x = block.pos[0] + block.size[0]
-            bottom_y = block.pos[1]
-            top_y = block.pos[1] + block.size[1]
-
-            # going left
-            if self.pos[0] + self.r >= left_x and \
-               self.pos[0]+self.r <= right_x and \
-               self.pos[1] >= bottom_y and self.pos[1] <= top_y:
-
-                self.vel[0] *= -1
-                self.pos[0] = left_x - self.r
-                self.bounces -= 1
-                self.text.set_text(str(self.bounces))
-                block.flash()
-
-                collide = True
-
-            # going right
-            if self.pos[0] - self.r <= right_x and \
-               self.pos[0]-self.r >= left_x and \
-               self.pos[1] >= bottom_y and self.pos[1] <= top_y:
-
-                self.vel[0]*=-1
-                self.pos[0] = right_x + self.r
-                self.bounces -= 1
-                self.text.set_text(str(self.bounces))
-                block.flash()
-
-                collide = True
-
-            # going up
-            if self.pos[1] + self.r >= bottom_y and \
-               self.pos[1] + self.r <= top_y and \
-               self.pos[0] >= left_x and self.pos[0] <= right_x:
-
-                self.vel[1] *= -1
-                self.pos[1] = bottom_y - self.r
-                self.bounces -= 1
-                self.text.set_text(str(self.bounces))
-                block.flash()
-
-                collide = True
-
-            # going down
-            if self.pos[1] - self.r <= top_y and \
-               self.pos[1]-self.r >= bottom_y and \
-               self.pos[0] >= left_x and self.pos[0] <= right_x:
-
-                self.vel[1] *= -1
-                self.pos[1] = top_y + self.r
-                self.bounces -= 1
-                self.text.set_text(str(self.bounces))
-                block.flash()
-
-                collide = True
-
-        return collide
+class PreviewPool(object):
+    """
+    Finished BubblePreviews, kept to be reused instead of reallocating their instructions on every
+    touch_down. Previews are keyed by timbre, since that decides their shape. hits and misses
+    count how often get() found a preview to reuse.
+    """
+    def __init__(self, size=pool_size):
+        """
+        :param size: most previews kept per timbre, beyond which recycled ones are dropped
+        """
+        self.size = size
+        self.free = {} # lists of reusable previews, keyed by timbre
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, timbre):
+        """Returns a reusable preview of the given timbre, or None if there aren't any."""
+
+        free = self.free.get(timbre)
+        if free:
+            self.hits += 1
+            return free.pop()
+        self.misses += 1
+        return None
+
+    def put(self, preview):
+        free = self.free.setdefault(preview.timbre, [])
+        if len(free) < self.size:
+            free.append(preview)
 
 class PhysicsBubbleHandler(object):
     """
@@ -216,11 +163,22 @@ class PhysicsBubbleHandler(object):
     Handles the PhysicsBubble GUI.
     Also stores and updates all currently active PhysicsBubbles.
     """
-    def __init__(self, norm, sandbox, mixer, client, client_id, block_handler):
+    def __init__(
+        self, norm, sandbox, mixer, client, client_id, block_handler, lookahead=sound_lookahead
+    ):
         self.norm = norm
         self.module_name = 'PhysicsBubble'
         self.sandbox = sandbox
+
+        # collision sounds are posted to an audio scheduler, which starts each note on the exact
+        # audio frame of its onset rather than at the start of the next audio buffer
         self.mixer = mixer
+        self.tempo_map = SimpleTempoMap(bpm=60)
+        self.sched = AudioScheduler(self.tempo_map)
+        self.notes = Mixer()
+        self.sched.set_generator(self.notes)
+        self.mixer.add(self.sched)
+        self.lookahead = lookahead
         self.client = client
         self.cid = client_id
         self.block_handler = block_handler
@@ -228,11 +186,9 @@ class PhysicsBubbleHandler(object):
         # many variables here are dicts because a user's module handler needs to keep track of
         # not just its own variables, but other users' variables as well! so we use dictionaries
         # with client ids as the keys.
-        self.hold_line = {}
         self.hold_point = {}
-        self.hold_shape = {}
-        self.text = {}
-        self.text_color = Color(0, 0, 0)
+        self.previews = {}
+        self.preview_pool = PreviewPool()
 
         # this mysterious variable is needed for a race condition in which touch_up events are
         # sometimes registered before touch_down events when the user clicks too fast, causing
@@ -270,13 +226,42 @@ class PhysicsBubbleHandler(object):
         self.timbre = {}
         self.bounces = {}
         self.gravity = {}
+        self.collide = False # room-wide toggle for bubble-bubble collisions
+
+        # version of the last state delta applied from the server, or None before initial sync.
+        # self.sent holds this client's field values as of its last update to the server.
+        self.version = None
+        self.sent = {}
 
         # flag used to only display controls when this module is synced
         # see on_update() and sync_state()
         self.display = False
 
-        self.bubbles = AnimGroup()
-        self.sandbox.add(self.bubbles)
+        # all bubbles are simulated together by the world. self.views maps world slots to their
+        # PhysicsBubbles.
+        self.world = BubbleWorld(scale=self.norm.nv(1))
+        self.views = {}
+
+        # in lockstep (see set_lockstep), bubbles are released on the tick that the server stamped
+        # on their touch_up, and are identified across clients by (tick, cid, n) spawn keys
+        self.room_clock = None
+        self.spawns = [] # (key, args) of bubbles waiting for their tick, sorted by key
+        self.spawned = [] # (key, args) of recently released bubbles
+        self.keys = {} # spawn key of each bubble, keyed by world slot
+
+        # when the server simulates bubbles (see set_server_physics), bubbles are drawn from the
+        # snapshots it streams rather than simulated by the world
+        self.streamed = False
+        self.stream_slots = {} # (world slot, spawn tick) of each streamed bubble, keyed by id
+        self.snapshots = [] # recent (tick, {id: (pos, bounces)}) snapshots, oldest first
+
+        # bubbles and previews show their bounce counts with textures rendered once and shared,
+        # so a collision only swaps a label's texture
+        self.labels = LabelCache(str(n) for n in range(prerendered_bounces + 1))
+
+        # every bubble is drawn by one BubbleMesh, straight from the world's arrays
+        self.mesh = BubbleMesh(self.norm, self.world, self.labels)
+        self.sandbox.add(self.mesh)
 
         # GUI elements
         self.gui = BubbleGUI(
@@ -306,34 +291,50 @@ class PhysicsBubbleHandler(object):
             return
 
         # start drawing drag line and preview of the PhysicsBubble
+        if cid in self.previews:
+            self.recycle_preview(cid)
         self.hold_point[cid] = pos
-        self.hold_shape[cid] = self.timbre_to_shape(self.timbre[cid], pos)
-        self.hold_line[cid] = Line(points=(*pos, *pos), width=3)
-        self.text[cid] = CLabelRect(cpos=pos, text=str(self.bounces[cid]))
+        timbre = self.timbre[cid]
+        preview = self.preview_pool.get(timbre)
+        if preview is None:
+            shape = self.timbre_to_shape(timbre, pos)
+            preview = BubblePreview(
+                self.labels, shape, timbre, pos, self.color[cid], self.bounces[cid]
+            )
+        else:
+            preview.reset(pos, self.color[cid], self.bounces[cid])
+        self.previews[cid] = preview
 
         # if self.skip.get(cid) == True:
         #     self.skip[cid] = False
         #     return
 
-        self.sandbox.add(Color(*self.color[cid]))
-        self.sandbox.add(self.hold_shape[cid])
-        self.sandbox.add(self.hold_line[cid])
-        self.sandbox.add(self.text_color)
-        self.sandbox.add(self.text[cid])
+        self.sandbox.add(preview)
 
     def on_touch_move(self, cid, pos):
-        if not self.sandbox.in_bounds(pos):
+        # drags that started outside of the sandbox have no preview
+        if cid not in self.previews or not self.sandbox.in_bounds(pos):
             return
 
         # update the position of the drag line and preview of the PhysicsBubble
-        self.hold_shape[cid].set_cpos(pos)
-        self.text[cid].set_cpos(pos)
-        self.hold_line[cid].points = (*self.hold_point[cid], *pos)
-
-    def on_touch_up(self, cid, pos):
-        if (self.hold_shape.get(cid) not in self.sandbox) or \
-           (self.text.get(cid) not in self.sandbox) or \
-           (self.hold_line.get(cid) not in self.sandbox):
+        self.previews[cid].set_cpos(self.hold_point[cid], pos)
+
+    def recycle_preview(self, cid):
+        preview = self.previews.pop(cid, None)
+        if preview is None:
+            return
+        if preview in self.sandbox:
+            self.sandbox.remove(preview)
+        self.preview_pool.put(preview)
+
+    def on_touch_up(self, cid, pos, tick=None):
+        """
+        :param tick: in lockstep, the room tick on which to release the bubble
+        """
+        if cid not in self.hold_point:
+            return # the drag started outside of the sandbox, so there's nothing to release
+
+        if self.previews.get(cid) not in self.sandbox:
             # if we were currently drawing a preview shape/line but released the mouse out of
             # bounds, we should release the shape anyway as a QOL measure
             if not self.sandbox.in_bounds(pos):
@@ -342,12 +343,10 @@ class PhysicsBubbleHandler(object):
             #     self.skip[cid] = True
             #     return
 
-        self.sandbox.remove(self.hold_shape[cid])
-        self.sandbox.remove(self.text[cid])
-        self.sandbox.remove(self.hold_line[cid])
+        self.recycle_preview(cid)
 
         # calculate velocity
-        hold_point = self.hold_point[cid]
+        hold_point = self.hold_point.pop(cid)
         dx = pos[0] - hold_point[0]
         dy = pos[1] - hold_point[1]
         vel = (-dx, -dy)
@@ -358,12 +357,27 @@ class PhysicsBubbleHandler(object):
         bounces = self.bounces[cid]
         gravity = self.gravity[cid]
 
-        # release the PhysicsBubble
+        args = (pos, vel, pitch, timbre, color, bounces, gravity)
+        if self.streamed:
+            return # the server releases the bubble
+        elif tick is None:
+            self.release(args)
+        else:
+            n = len([key for key, _ in self.spawns + self.spawned if key[:2] == (tick, cid)])
+            self.spawns.append(((tick, cid, n), args))
+            self.spawns.sort(key=lambda spawn: spawn[0])
+
+    def release(self, args, key=None):
+        """Release a PhysicsBubble. args are (pos, vel, pitch, timbre, color, bounces, gravity)."""
+
+        pos, vel, pitch, timbre, color, bounces, gravity = args
         bubble = PhysicsBubble(
-            self.norm, self.sandbox, pos, vel, pitch, timbre, color, bounces, self,
-            gravity=gravity, callback=self.sound
+            self.norm, self.world, self.mesh, pos, vel, pitch, timbre, color, bounces,
+            gravity=gravity
         )
-        self.bubbles.add(bubble)
+        self.views[bubble.slot] = bubble
+        self.keys[bubble.slot] = key
+        return bubble
 
     def on_key_down(self, cid, key):
         index = lookup(key, 'q2w3er5t6y7ui', range(13))
@@ -394,17 +408,28 @@ class PhysicsBubbleHandler(object):
                 self.gravity[cid] = not self.gravity[cid]
                 self.gui.gs.toggle()
 
-        # other clients should update their state to reflect this client's new selection.
+        if key == 'b': # toggle bubble-bubble collisions for the whole room
+            self.set_collide(not self.collide)
+
+        # other clients should update their state to reflect this client's new selection. only
+        # changed fields are sent, and gravity is only toggled locally, so this is posted. every
+        # client toggles collisions itself, so the room-wide change is only sent by this client.
         if self.cid == cid: # don't want every client updating server's state at the same time!
-            self.update_server_state(post=False)
+            self.update_server_state(post=True)
 
-    def sound(self, pitch, timbre):
+    def sound(self, pitch, timbre, delay=0):
         """
         Play a sound when a PhysicsBubble collides with a collidable object.
+        :param delay: seconds from now on the audio clock at which the sound starts
         """
+        tick = self.tempo_map.time_to_tick(self.sched.get_time() + max(delay, 0))
+        self.sched.post_at_tick(self._noteon, tick, (pitch, timbre))
+
+    def _noteon(self, tick, args):
+        pitch, timbre = args
         note = NoteGenerator(pitch, 1, timbre)
         env = Envelope(note, 0.01, 1, 0.2, 2)
-        self.mixer.add(env)
+        self.notes.add(env)
 
     def update_pitch(self, color, pitch):
         """Update this client's color and pitch due to PitchSelect."""
@@ -431,49 +456,293 @@ class PhysicsBubbleHandler(object):
         self.bounces[self.cid] = bounces
         self.update_server_state(post=True)
 
+    def set_collide(self, collide):
+        self.collide = collide
+        self.world.bubble_collisions = collide
+
     def display_controls(self):
         """Provides additional text info specific to this module to go on the top-left label."""
 
-        return 'click and drag!'
+        info = 'click and drag!\n\n'
+        info += 'bubble collisions: {}\n'.format('on' if self.collide else 'off')
+        info += 'preview pool: {} hits, {} misses\n'.format(
+            self.preview_pool.hits, self.preview_pool.misses
+        )
+        return info
 
     def on_update(self):
-        self.bubbles.on_update()
+        bounds = (
+            self.sandbox.pos[0],
+            self.sandbox.pos[1],
+            self.sandbox.pos[0] + self.sandbox.width,
+            self.sandbox.pos[1] + self.sandbox.height
+        )
+        if self.streamed:
+            collisions = []
+            self.interpolate()
+        elif self.room_clock is not None:
+            collisions = self.step_lockstep(bounds)
+        else:
+            collisions = self.world.step(kivyClock.frametime, bounds, self.block_handler.grid)
+
+        # every impact is exact, so each one flashes its block and sounds the bubble. sounds keep
+        # the impacts' spacing within the frame by playing each one lookahead seconds after it.
+        now = self.world.time + self.world.accumulator
+        for slot, block, time in collisions:
+            bubble = self.views[slot]
+            delay = self.lookahead - (now - time)
+            if block is not None:
+                block.flash(delay)
+            self.sound(bubble.pitch, bubble.timbre, delay)
+
+        self.mesh.on_update(kivyClock.frametime)
+        # bubbles that finished fading have freed their world slots, which the world reuses
+        for slot in [slot for slot in self.views if not self.world.alive[slot]]:
+            del self.views[slot]
+            if self.streamed:
+                del self.stream_slots[self.keys[slot]]
+            del self.keys[slot]
         self.gui.on_update(Window.mouse_pos)
 
-    def update_server_state(self, post=False):
-        """Update server state. If post is True, relay this updated state to all clients."""
+    def set_lockstep(self, room_clock):
+        """
+        Switch to the room's deterministic lockstep simulation.
+        :param room_clock: the room's clock, which gives the tick that the room is on
+        """
+        self.room_clock = room_clock
+        self.world.lockstep = True
+        self.world.expire_ticks = lockstep_expire_ticks
+        self.world.tick = room_clock.get_tick()
+        self.world.time = self.world.tick * step_size
+
+    def set_server_physics(self, room_clock, bubbles):
+        """
+        Switch to drawing the bubbles that the server simulates.
+        :param room_clock: the room's clock, which gives the tick that the room is on
+        :param bubbles: spawn info of the bubbles already in flight (see add_streamed)
+        """
+        self.room_clock = room_clock
+        self.streamed = True
+        for info in bubbles:
+            self.add_streamed(info)
+
+    def add_streamed(self, info):
+        """
+        Draw a bubble released by the server.
+        :param info: the bubble's id, spawn tick, sandbox-relative pos and vel, and settings
+        """
+        if info['id'] in self.stream_slots:
+            return # already sent when we joined
+        pos = self.sandbox.from_local(info['pos'])
+        vel = np.array(info['vel']) * self.sandbox.width
+        args = (
+            pos, vel / 2, # PhysicsBubble doubles release velocities
+            info['pitch'], info['timbre'], info['color'], info['bounces'], info['gravity']
+        )
+        bubble = self.release(args, info['id'])
+        self.stream_slots[info['id']] = (bubble.slot, info['tick'])
+
+    def add_snapshot(self, packet):
+        tick, bubbles = decode_snapshot(packet)
+        bubbles = {
+            bubble_id: (np.array(self.sandbox.from_local(uv)), bounces)
+            for bubble_id, uv, bounces in bubbles
+        }
+        self.snapshots.append((tick, bubbles))
+        self.snapshots.sort(key=lambda snapshot: snapshot[0])
+
+    def render_tick(self):
+        """Returns the (fractional) tick at which streamed bubbles are drawn."""
+
+        return self.room_clock.get_time() * tick_rate - interp_delay
 
-        state = {
+    def interpolate(self):
+        """Move streamed bubbles to where they were at the render tick, between two snapshots."""
+
+        render_tick = self.render_tick()
+
+        # the latest snapshot at or before the render tick, and the one after it, if any
+        while len(self.snapshots) > 2 and self.snapshots[1][0] <= render_tick:
+            self.snapshots.pop(0)
+        if not self.snapshots:
+            return
+        before = self.snapshots[0]
+        after = self.snapshots[1] if len(self.snapshots) > 1 else before
+        span = after[0] - before[0]
+        t = min(max((render_tick - before[0]) / span, 0), 1) if span else 0
+
+        for bubble_id, (slot, spawn_tick) in self.stream_slots.items():
+            start, end = before[1].get(bubble_id), after[1].get(bubble_id)
+            if start is None and end is None:
+                # not in either snapshot after its release, so the server is done with it
+                if spawn_tick < before[0]:
+                    self.world.bounces[slot] = 0
+                continue
+
+            start, end = start or end, end or start
+            self.world.pos[slot] = start[0] + (end[0] - start[0]) * t
+            if span:
+                self.world.vel[slot] = (end[0] - start[0]) * tick_rate / span
+            self.world.bounces[slot] = start[1] if t < 1 else end[1]
+
+    def on_bubble_hit(self, hit):
+        """
+        Sound a streamed bubble's collision when it's drawn there, and flash the block it hit.
+        :param hit: the bubble's id, the tick of the collision, and the sandbox-relative point on
+            the block it hit (None for edges and other bubbles)
+        """
+        if hit['id'] not in self.stream_slots:
+            return
+        view = self.views[self.stream_slots[hit['id']][0]]
+        delay = (hit['tick'] - self.render_tick()) / tick_rate
+        self.sound(view.pitch, view.timbre, delay)
+
+        if hit['point'] is not None:
+            x, y = self.sandbox.from_local(hit['point'])
+            blocks = self.block_handler.grid.query(x - 1, y - 1, x + 1, y + 1)
+            if blocks:
+                blocks[0].flash(max(delay, 0))
+
+    def step_lockstep(self, bounds):
+        """Simulate every tick up to the room's current tick, releasing bubbles on their tick."""
+
+        collisions = []
+        ticks = min(self.room_clock.get_tick() - self.world.tick, lockstep_catchup)
+        for _ in range(max(ticks, 0)):
+            # a release that arrives after its tick is released late, and corrected by a snapshot
+            while self.spawns and self.spawns[0][0][0] <= self.world.tick:
+                key, args = self.spawns.pop(0)
+                self.release(args, key)
+                self.spawned.append((key, args))
+
+            collisions += self.world.substep(bounds, self.block_handler.grid)
+            if self.world.tick % hash_interval == 0:
+                self.send_state_hash()
+
+        oldest = self.world.tick - spawn_history
+        self.spawned = [spawn for spawn in self.spawned if spawn[0][0] >= oldest]
+        return collisions
+
+    def lockstep_slots(self):
+        """Returns the slots of every bubble that still collides, in spawn key order."""
+
+        world = self.world
+        keyed = [
+            (key, slot) for slot, key in self.keys.items()
+            if key is not None and world.alive[slot] and world.bounces[slot] > 0
+        ]
+        return [slot for key, slot in sorted(keyed)]
+
+    def send_state_hash(self):
+        data = {
+            'cid': self.cid,
+            'tick': self.world.tick,
+            'hash': self.world.state_hash(self.lockstep_slots(), self.sandbox.pos)
+        }
+        self.client.emit('state_hash', data)
+
+    def send_snapshot(self):
+        """Send the state of every colliding bubble, for the server to correct desynced clients."""
+
+        bubbles = []
+        for slot in self.lockstep_slots():
+            view = self.views[slot]
+            bubbles.append({
+                'key': self.keys[slot],
+                'pos': self.world.to_units(self.world.pos[slot], self.sandbox.pos).tolist(),
+                'vel': self.world.to_units(self.world.vel[slot]).tolist(),
+                'bounces': int(self.world.bounces[slot]),
+                'gravity': bool(self.world.gravity[slot]),
+                'pitch': view.pitch,
+                'timbre': view.timbre,
+                'color': view.color
+            })
+        data = {'cid': self.cid, 'tick': self.world.tick, 'bubbles': bubbles}
+        self.client.emit('snapshot', data)
+
+    def restore_snapshot(self, snapshot):
+        """Replace every bubble with those of a snapshot, and resimulate from its tick."""
+
+        for slot in self.views:
+            self.world.remove(slot)
+        self.views = {}
+        self.keys = {}
+
+        tick = snapshot['tick']
+        self.world.tick = tick
+        self.world.time = tick * step_size
+        for bubble in snapshot['bubbles']:
+            pos = self.world.from_units(bubble['pos'], self.sandbox.pos)
+            vel = self.world.from_units(bubble['vel'])
+            args = (
+                pos, vel / 2, # PhysicsBubble doubles release velocities
+                bubble['pitch'], bubble['timbre'], bubble['color'], bubble['bounces'],
+                bubble['gravity']
+            )
+            self.release(args, tuple(bubble['key']))
+
+        # bubbles released on or after the snapshot's tick aren't in it, so release them again
+        replay = {key: args for key, args in self.spawned + self.spawns if key[0] >= tick}
+        self.spawns = sorted(replay.items(), key=lambda spawn: spawn[0])
+        self.spawned = []
+
+    def get_state(self):
+        """Returns this module's syncable state, keyed by field."""
+
+        return {
             'color': self.color,
             'pitch': self.pitch,
             'timbre': self.timbre,
             'bounces': self.bounces,
-            'gravity': self.gravity
+            'gravity': self.gravity,
+            'collide': self.collide
         }
-        data = {'module': self.module_name, 'cid': self.cid, 'state': state, 'post': post}
+
+    def set_state(self, state):
+        self.color = state['color']
+        self.pitch = state['pitch']
+        self.timbre = state['timbre']
+        self.bounces = state['bounces']
+        self.gravity = state['gravity']
+        self.set_collide(state['collide'])
+
+    def update_server_state(self, post=False):
+        """
+        Send the fields of this client's state that changed since the last update to the server.
+        If post is True, relay the changes to all clients.
+        """
+        deltas = client_deltas(self.cid, self.get_state(), self.sent)
+        if not deltas:
+            return
+        data = {'module': self.module_name, 'cid': self.cid, 'deltas': deltas, 'post': post}
         self.client.emit('update_state', data)
 
-    def update_client_state(self, cid, state):
-        """Update this handler's state."""
+    def update_client_state(self, cid, deltas):
+        """Apply another client's state deltas to this handler's state."""
 
         if cid != self.cid: # this client already updated its own state
-            self.color = state['color']
-            self.pitch = state['pitch']
-            self.timbre = state['timbre']
-            self.bounces = state['bounces']
-            self.gravity = state['gravity']
+            state = self.get_state()
+            apply_deltas(state, deltas, self.sent)
+            self.set_collide(state['collide'])
+
+    def resync_state(self, state, version):
+        """Replace this handler's state with the server's copy after missing a delta."""
+
+        keep_client_entries(state, self.get_state(), self.cid)
+        self.set_state(state)
+        self.version = version
 
-    def sync_state(self, state):
+    def sync_state(self, state, version):
         """
         Initial sync with the server's copy of module state.
-        We don't sync with hold_shape, hold_point, and hold_line because those objects are not
-        json-serializable and are short-term values anyway.
+        We don't sync with hold_point and previews because those objects are not json-serializable
+        and are short-term values anyway.
         """
-        self.color = state['color']
-        self.pitch = state['pitch']
-        self.timbre = state['timbre']
-        self.bounces = state['bounces']
-        self.gravity = state['gravity']
+        self.set_state(state)
+        self.version = version
+
+        # the room's collision toggle came from the server, so there's no need to send it back
+        self.sent['collide'] = self.collide
 
         # after initial sync, add default values for this client
         self.color[self.cid] = self.default_color
@@ -0,0 +1,220 @@
+from kivy.graphics import Mesh, RenderContext
+
+import numpy as np
+
+# how long a bubble takes to fade away once it's out of bounces
+fade_duration = 0.25
+
+# mesh indices are unsigned shorts, so larger batches are split across several meshes
+max_vertices = 65535
+
+vertex_format = [
+    (b'vPosition', 2, 'float'),
+    (b'vTexCoords0', 2, 'float'),
+    (b'vColor', 4, 'float')
+]
+
+# Kivy's default shaders, except that colors come from each vertex rather than a Color instruction
+vertex_shader = '''
+$HEADER$
+attribute vec4 vColor;
+
+void main(void) {
+    frag_color = vColor * vec4(1.0, 1.0, 1.0, opacity);
+    tex_coord0 = vTexCoords0;
+    gl_Position = projection_mat * modelview_mat * vec4(vPosition.xy, 0.0, 1.0);
+}
+'''
+
+fragment_shader = '''
+$HEADER$
+
+void main(void) {
+    gl_FragColor = frag_color * texture2D(texture0, tex_coord0);
+}
+'''
+
+# the shape of each timbre as (sides, radius, angle), matching the CEllipse or CRectangle that a
+# preview of it is drawn with. like Kivy's Ellipse, the first corner is at the top.
+timbre_shapes = {
+    'sine': (20, 40, 0),
+    'triangle': (3, 45, 0),
+    'square': (4, 40 * np.sqrt(2), np.pi / 4),
+    'sawtooth': (4, 45, 0) # square rotated 45 degrees
+}
+timbres = list(timbre_shapes)
+
+def polygon(sides, radius, angle=0):
+    """Returns the vertex offsets and triangle indices of a regular polygon, center first."""
+    angles = angle + 2 * np.pi * np.arange(sides) / sides
+    rim = np.stack((radius * np.sin(angles), radius * np.cos(angles)), axis=1)
+    offsets = np.concatenate((np.zeros((1, 2)), rim))
+    corners = np.arange(1, sides + 1)
+    indices = np.stack((np.zeros(sides, dtype=int), corners, corners % sides + 1), axis=1)
+    return offsets, indices.ravel()
+
+class MeshBatch(object):
+    """
+    Draws a batch of copies of one mesh layout, each with its own vertices, with as few Mesh
+    instructions as the index limit allows.
+    """
+    def __init__(self, group, vertex_count, indices, texture=None):
+        """
+        :param group: the instruction group that meshes are added to
+        :param vertex_count: number of vertices in each copy
+        :param indices: triangle indices into each copy's vertices
+        :param texture: texture of the copies, if any
+        """
+        self.group = group
+        self.vertex_count = vertex_count
+        self.indices = indices
+        self.texture = texture
+        self.per_mesh = max_vertices // vertex_count # copies that fit in one mesh
+        self.meshes = []
+
+    def upload(self, vertices, copies=None):
+        """
+        :param vertices: (k, vertex_count, 8) array of every copy's vertices (see vertex_format)
+        :param copies: indices of the copies that changed since the last upload, or None if they
+            all may have. only the meshes holding them are updated.
+        """
+        count, n = len(vertices), self.vertex_count
+        chunks = -(-count // self.per_mesh)
+        while len(self.meshes) < chunks:
+            mesh = Mesh(fmt=vertex_format, mode='triangles', texture=self.texture)
+            self.meshes.append(mesh)
+            self.group.add(mesh)
+
+        changed = range(len(self.meshes))
+        if copies is not None:
+            changed = np.unique(np.asarray(copies) // self.per_mesh).tolist()
+
+        for i in changed:
+            chunk = vertices[i * self.per_mesh:(i + 1) * self.per_mesh]
+            indices = np.arange(len(chunk))[:, None] * n + self.indices
+            self.meshes[i].vertices = chunk.ravel().tolist()
+            self.meshes[i].indices = indices.ravel().tolist()
+
+class ShapeBatch(MeshBatch):
+    """Draws any number of copies of one shape, each with its own position and color."""
+    def __init__(self, group, offsets, indices, texture=None):
+        """
+        :param group: the instruction group that meshes are added to
+        :param offsets: (n, 2) array of the shape's vertices, relative to its position
+        :param indices: triangle indices into offsets
+        :param texture: texture of the shape, if any
+        """
+        super(ShapeBatch, self).__init__(group, len(offsets), indices, texture)
+        self.offsets = offsets
+
+    def draw(self, positions, colors, tex_coords=None):
+        """
+        :param positions: (k, 2) array of where to draw each copy
+        :param colors: (k, 4) array of each copy's RGBA color
+        :param tex_coords: (k, n, 2) array of each copy's texture coordinates, if textured
+        """
+        vertices = np.zeros((len(positions), self.vertex_count, 8))
+        vertices[:, :, :2] = positions[:, None] + self.offsets
+        if tex_coords is not None:
+            vertices[:, :, 2:4] = tex_coords
+        vertices[:, :, 4:] = colors[:, None]
+        self.upload(vertices)
+
+class BubbleMesh(RenderContext):
+    """
+    Draws every bubble in a BubbleWorld, with its bounce count, in a handful of meshes: one batch
+    per timbre and one for the bounce count digits. Vertices are built from the world's arrays each
+    frame, so drawing costs a few numpy operations however many bubbles there are.
+
+    Bubbles also fade away here once they're out of bounces, after which their slots are freed,
+    unless the world frees them on its own tick (see BubbleWorld.expire_ticks).
+    """
+    def __init__(self, norm, world, labels):
+        """
+        :param norm: normalizer
+        :param world: the BubbleWorld whose bubbles are drawn
+        :param labels: LabelCache to render the bounce count digits with
+        """
+        super(BubbleMesh, self).__init__(use_parent_projection=True, use_parent_modelview=True)
+        self.shader.vs = vertex_shader
+        self.shader.fs = fragment_shader
+        self.world = world
+
+        self.shapes = []
+        for timbre in timbres:
+            sides, radius, angle = timbre_shapes[timbre]
+            offsets, indices = polygon(sides, norm.nv(radius), angle)
+            self.shapes.append(ShapeBatch(self, offsets, indices))
+
+        # digits are cut out of one rendered string of all ten, which works since the default
+        # font's digits all have the same width
+        atlas = labels.get('0123456789')
+        width, height = atlas.width / 10, atlas.height
+        offsets = np.array(((-width, -height), (width, -height), (width, height), (-width, height)))
+        self.digit_width = width
+        self.digits = ShapeBatch(self, offsets / 2, np.array((0, 1, 2, 0, 2, 3)), texture=atlas)
+
+        # texture coordinates of each digit's corners, in the same order as the offsets
+        u0, v0, u1, v1, u2, v2, u3, v3 = atlas.tex_coords
+        left = np.linspace(0, 0.9, 10)[:, None]
+        right = left + 0.1
+        bottom = np.array(((u0, v0),)) + np.array(((u1 - u0, v1 - v0),)) * np.stack((left, right))
+        top = np.array(((u3, v3),)) + np.array(((u2 - u3, v2 - v3),)) * np.stack((left, right))
+        self.digit_coords = np.stack((bottom[0], bottom[1], top[1], top[0]), axis=1)
+
+        # drawing state of each world slot
+        self.timbre = np.zeros(0, dtype=int)
+        self.rgba = np.zeros((0, 4))
+        self.fade_time = np.zeros(0)
+
+    def fit(self):
+        """Grow the slot arrays to match the world's capacity."""
+        extra = len(self.world.alive) - len(self.timbre)
+        if extra > 0:
+            self.timbre = np.concatenate((self.timbre, np.zeros(extra, dtype=int)))
+            self.rgba = np.concatenate((self.rgba, np.ones((extra, 4))))
+            self.fade_time = np.concatenate((self.fade_time, np.zeros(extra)))
+
+    def show(self, slot, timbre, color):
+        """Start drawing the bubble in a newly added slot."""
+        self.fit()
+        self.timbre[slot] = timbres.index(timbre)
+        self.rgba[slot] = (*color, 1)
+        self.fade_time[slot] = 0
+
+    def on_update(self, dt):
+        self.fit()
+        world = self.world
+        alive = world.alive.copy()
+
+        # bubbles that are out of bounces fade away, and free their slots once they're gone. so do
+        # bubbles that have stopped without gravity, since they would never make a sound.
+        stopped = ~world.gravity & np.all(world.vel == 0, axis=1)
+        fading = alive & ((world.bounces <= 0) | stopped)
+        self.rgba[fading, 3] = np.clip(1 - self.fade_time[fading] / fade_duration, 0, 1)
+        self.fade_time[fading] += dt
+        if world.expire_ticks is None:
+            for slot in np.flatnonzero(fading & (self.fade_time >= fade_duration)).tolist():
+                world.remove(slot)
+
+        for index, batch in enumerate(self.shapes):
+            slots = np.flatnonzero(alive & (self.timbre == index))
+            batch.draw(world.pos[slots], self.rgba[slots])
+
+        # each bounce count is drawn a digit at a time, from the ones place up
+        slots = np.flatnonzero(alive)
+        counts = np.maximum(world.bounces[slots], 0)
+        lengths = np.floor(np.log10(np.maximum(counts, 1))).astype(int) + 1
+        positions, digits = [], []
+        for place in range(lengths.max() if len(slots) else 0):
+            shown = place < lengths
+            offset = (lengths[shown] - 1) / 2 - place
+            position = world.pos[slots[shown]].copy()
+            position[:, 0] += offset * self.digit_width
+            positions.append(position)
+            digits.append(counts[shown] // 10 ** place % 10)
+
+        positions = np.concatenate(positions) if positions else np.zeros((0, 2))
+        digits = np.concatenate(digits) if digits else np.zeros(0, dtype=int)
+        colors = np.tile((0, 0, 0, 1), (len(digits), 1))
+        self.digits.draw(positions, colors, self.digit_coords[digits])
@@ -1,15 +1,27 @@
-import copy, math
+import bisect, copy, heapq, math
 import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 
-from common.clock import Clock, SimpleTempoMap, Scheduler
+from common.clock import Clock
 from common.clock import tick_str, kTicksPerQuarter, quantize_tick_up
 from common.gfxutil import CEllipse, AnimGroup
 from kivy.graphics import Color, Line, Rectangle
 from kivy.graphics import PushMatrix, PopMatrix, Rotate, Translate
 from kivy.graphics.instructions import InstructionGroup
 
+from protocol import client_deltas, apply_deltas, keep_client_entries, tempo_change_delay
 from modules.cursor_gui import CursorGUI
+from modules.tempo import TempoMap, curves
+
+# cursor hits are dispatched this many seconds ahead of time, and sounded on the audio clock at
+# their exact tick, so that notes don't depend on the graphics frame they were dispatched in
+cursor_lookahead = 0.05
+
+ticks_per_sixteenth = kTicksPerQuarter // 4
+ticks_per_measure = kTicksPerQuarter * 4
+
+# tempo changes with a 'linear' or 'exp' curve ramp to the new tempo over this many beats
+tempo_ramp_beats = 4
 
 def in_bounds(mouse_pos, obj_pos, obj_size):
     """
@@ -30,7 +42,15 @@ class TempoCursor(InstructionGroup):
     """
     name = 'TempoCursor'
 
-    def __init__(self, norm, pos, tempo, clock, tempo_map, touch_points, block_handler):
+    def __init__(self, norm, pos, tempo, sched, touch_points, block_handler):
+        """
+        :param norm: normalizer
+        :param pos: center of the cursor
+        :param tempo: the room's tempo
+        :param sched: the room's CursorScheduler, which fires this cursor on its touch points
+        :param touch_points: 16th notes of each measure on which the cursor touches, 0..15
+        :param block_handler: the SoundBlockHandler whose blocks the cursor touches
+        """
         super(TempoCursor, self).__init__()
         self.norm = norm
         self.pos = pos
@@ -41,15 +61,22 @@ class TempoCursor(InstructionGroup):
         self.add(self.cursor)
 
         self.tempo = tempo
-        self.clock = clock
-        self.tempo_map = tempo_map
-        self.sched = Scheduler(self.clock, self.tempo_map)
+        self.sched = sched
+        self.active = True # until the cursor is deleted
 
         self.block_handler = block_handler
 
+        # cursors and blocks don't move, so the blocks under this cursor are only looked up once.
+        # TempoCursorHandler keeps this up to date as blocks are added and deleted.
+        x, y = pos
+        self.blocks = self.block_handler.grid.query(x, y, x, y)
+
         # 0..15, for 16th note granularity
         self.touch_points = touch_points
-        self.index = 0
+
+        # the touch points compiled into ticks from the start of a measure, so that each hit's tick
+        # follows from the last one's rather than from when it happened to be dispatched
+        self.pattern = sorted(set(point * ticks_per_sixteenth for point in touch_points))
 
         # add touch markers
         self.add(PushMatrix())
@@ -71,62 +98,82 @@ class TempoCursor(InstructionGroup):
         self.add(self.time_marker)
         self.add(PopMatrix())
 
-        self.on_update(0)
-
         cur_tick = self.sched.get_tick()
-        next_tick = quantize_tick_up(cur_tick, kTicksPerQuarter * 4)
-        next_tick += self.calculate_tick_interval(0, self.touch_points[0])
-        self.sched.post_at_tick(self.touch_down, next_tick)
+        self.on_update(cur_tick)
 
-    def on_update(self, dt):
-        self.sched.on_update()
+        # start on the first touch point of the next measure
+        next_tick = quantize_tick_up(cur_tick, ticks_per_measure) + self.pattern[0]
+        self.sched.post(self, next_tick)
 
-        cur_time = self.sched.get_time()
-        cur_tick = self.sched.get_tick()
-        angle = (360 * (cur_tick / (kTicksPerQuarter * 4))) % 360
+    def on_update(self, tick):
+        angle = (360 * (tick / (kTicksPerQuarter * 4))) % 360
         self.rotate.angle = -angle
 
-    def calculate_tick_interval(self, p1, p2):
-        if p2 > p1:
-            return (p2 - p1)/4 * kTicksPerQuarter
-        elif p1 > p2:
-            return (p2 + 16 - p1)/4 * kTicksPerQuarter
-        else:
-            return 0
+    def hit_after(self, tick):
+        """Returns the tick of this cursor's first touch point after the given tick."""
 
-    def round_to_sixteenth(self, tick):
-        kTicksPerSixteenth = kTicksPerQuarter / 4
-        kTicksPerMeasure = kTicksPerQuarter * 4
-        measure = math.floor(tick / kTicksPerMeasure)
-        beat = round(16 * ((tick % kTicksPerMeasure) / kTicksPerMeasure))
-        return measure * kTicksPerMeasure + (beat * kTicksPerSixteenth)
+        measure = math.floor(tick / ticks_per_measure)
+        index = bisect.bisect_right(self.pattern, tick - measure * ticks_per_measure)
+        if index == len(self.pattern):
+            measure += 1
+            index = 0
+        return measure * ticks_per_measure + self.pattern[index]
 
-    def touch_down(self, tick):
-        self._touch_down()
+    def touches(self, block):
+        return in_bounds(self.pos, block.pos, block.size)
 
-        cur_tick = self.round_to_sixteenth(self.sched.get_tick())
-        next_index = (self.index + 1) % len(self.touch_points)
-        p1 = self.touch_points[self.index]
-        p2 = self.touch_points[next_index]
-        interval = kTicksPerQuarter * 4 if len(self.touch_points) == 1 \
-              else self.calculate_tick_interval(p1, p2)
-        next_tick = cur_tick + interval
+class CursorScheduler(object):
+    """
+    Fires every TempoCursor in a room from one priority queue of (tick, n, cursor) entries, so that
+    a frame only costs as much as the cursors that are due on it, however many cursors there are.
 
-        self.index = next_index
+    Hits are dispatched lookahead seconds early, and their blocks are sounded on the audio clock at
+    the hit's exact time.
+    """
+    def __init__(self, clock, tempo_map, lookahead=cursor_lookahead):
+        self.clock = clock
+        self.tempo_map = tempo_map
+        self.lookahead = lookahead
+        self.queue = []
+        self.count = 0 # breaks ties between cursors due on the same tick, in order of posting
 
-        self.sched.post_at_tick(self.touch_down, next_tick)
+    def get_tick(self):
+        return self.tempo_map.time_to_tick(self.clock.get_time())
 
-    def _touch_down(self):
-        for block in self.block_handler.blocks.objects:
-            if in_bounds(self.pos, block.pos, block.size):
-                block.flash()
+    def post(self, cursor, tick):
+        heapq.heappush(self.queue, (tick, self.count, cursor))
+        self.count += 1
+
+    def on_update(self):
+        now = self.clock.get_time()
+        tick = self.tempo_map.time_to_tick(now)
+        horizon = self.tempo_map.time_to_tick(now + self.lookahead)
+
+        # hits on the same tick fire as one batch, so a block under several cursors only flashes
+        # once for them
+        hits = {}
+        while self.queue and self.queue[0][0] <= horizon:
+            hit_tick, _, cursor = heapq.heappop(self.queue)
+            if not cursor.active: # deleted cursors are dropped when they come due
+                continue
+            for block in cursor.blocks:
+                hits[(hit_tick, block)] = True
+
+            # hits missed during a hitch aren't made up for, so the next hit is after now
+            self.post(cursor, cursor.hit_after(max(hit_tick, tick)))
+
+        for hit_tick, block in hits:
+            block.flash(self.tempo_map.tick_to_time(hit_tick) - now)
 
 class TempoCursorHandler(object):
     """
     Handles the TempoCursor GUI.
     Also stores and updates all currently active TempoCursors.
     """
-    def __init__(self, norm, sandbox, mixer, client, client_id, block_handler, tempo=60):
+    def __init__(
+        self, norm, sandbox, mixer, client, client_id, block_handler, tempo=60,
+        lookahead=cursor_lookahead
+    ):
         self.norm = norm
         self.module_name = 'TempoCursor'
         self.sandbox = sandbox
@@ -135,21 +182,34 @@ class TempoCursorHandler(object):
         self.cid = client_id
         self.block_handler = block_handler
 
+        # cursors follow the room's clock (see set_room_clock) and tempo map, so that every client
+        # in the room hits the same beats at the same time. self.tempo is the room's tempo, which
+        # the room pauses at when self.tempo_map's current tempo is 0.
         self.tempo = tempo
         self.clock = Clock()
-        self.tempo_map = SimpleTempoMap(bpm=self.tempo)
+        self.tempo_map = TempoMap(self.tempo)
 
         self.touch_points = {}
 
+        # version of the last state delta applied from the server, or None before initial sync.
+        # self.sent holds this client's field values as of its last update to the server.
+        self.version = None
+        self.sent = {}
+
         self.cursors = AnimGroup()
         self.sandbox.add(self.cursors)
 
+        # one scheduler fires every cursor in the room
+        self.sched = CursorScheduler(self.clock, self.tempo_map, lookahead)
+        self.block_handler.block_listeners.append(self.on_block_change)
+
         self.gui = CursorGUI(
             norm, pos=self.norm.nt((20, 300)),
             beat_callback=self.update_touch_points
         )
 
         self.delete_mode = {}
+        self.tempo_curve = {} # how each client's tempo changes get to the new tempo (see curves)
 
     def on_touch_down(self, cid, pos):
         if cid == self.cid:
@@ -164,6 +224,7 @@ class TempoCursorHandler(object):
                 if self.delete_mode[cid]:
                     self.cursors.objects.remove(cursor)
                     self.cursors.remove(cursor)
+                    cursor.active = False
                     return
 
         if self.delete_mode[cid]:
@@ -174,11 +235,19 @@ class TempoCursorHandler(object):
         if len(touch_points) == 0:
             return
         cursor = TempoCursor(
-            self.norm, pos, self.tempo, self.clock, self.tempo_map,
-            copy.deepcopy(touch_points), self.block_handler
+            self.norm, pos, self.tempo, self.sched, copy.deepcopy(touch_points), self.block_handler
         )
         self.cursors.add(cursor)
 
+    def on_block_change(self, block, added):
+        """Add or remove a block from the blocks under each cursor that it touches."""
+        for cursor in self.cursors.objects:
+            if cursor.touches(block):
+                if added:
+                    cursor.blocks.append(block)
+                else:
+                    cursor.blocks.remove(block)
+
     def on_touch_move(self, cid, pos):
         pass
 
@@ -186,22 +255,66 @@ class TempoCursorHandler(object):
         pass
 
     def on_key_down(self, cid, key):
-        if key == 'p':
-            self.clock.toggle()
+        # the client that pressed the key picks when the tempo changes, and tells everyone else
+        # through the room's tempo_changes
+        if key == 'p' and cid == self.cid:
+            self.change_tempo(self.tempo if self.is_paused() else 0)
         if key == 'v' and cid == self.cid:
             self.delete_mode[cid] = not self.delete_mode[cid]
             self.update_server_state(post=True)
-        if key == 'up':
-            self.tempo += 4
-            self.tempo_map.set_tempo(self.tempo)
+        if key in ('up', 'down') and cid == self.cid:
+            self.tempo = max(self.tempo + (4 if key == 'up' else -4), 4)
+            if not self.is_paused():
+                self.change_tempo(self.tempo, self.tempo_curve[cid])
             self.update_server_state(post=True)
-        if key == 'down':
-            self.tempo -= 4
-            self.tempo_map.set_tempo(self.tempo)
+        if key == 'r' and cid == self.cid:
+            curve = self.tempo_curve[cid]
+            self.tempo_curve[cid] = curves[(curves.index(curve) + 1) % len(curves)]
             self.update_server_state(post=True)
 
+    def is_paused(self):
+        """Returns whether the room is paused, or about to be."""
+        return self.tempo_map.changes[-1][2] == 0
+
+    def change_tempo(self, bpm, curve='step'):
+        """
+        Change the room's tempo to bpm on the first beat at least tempo_change_delay seconds from
+        now, so that the change reaches every client before it happens. A paused room resumes
+        tempo_change_delay seconds from now, from the tick it paused on.
+        :param curve: 'step' to change the tempo at once, or 'linear' or 'exp' to ramp to it over
+            tempo_ramp_beats beats. pausing and resuming always happen at once.
+        """
+        time = self.clock.get_time() + tempo_change_delay
+        tick = self.tempo_map.time_to_tick(time)
+        if self.is_paused() or bpm == 0 or curve == 'step':
+            if not self.is_paused():
+                tick = quantize_tick_up(tick, kTicksPerQuarter)
+                time = self.tempo_map.tick_to_time(tick)
+            self.tempo_map.add_change(tick, time, bpm)
+        else:
+            time = self.tempo_map.tick_to_time(quantize_tick_up(tick, kTicksPerQuarter))
+            duration = tempo_ramp_beats * 60 / self.tempo_map.get_tempo(time)
+            self.tempo_map.add_ramp(time, time + duration, bpm, curve)
+
+        # tempo_changes is synced whole, so it only keeps the changes that clients still need. the
+        # segment from tempo_change_delay seconds ago is kept for clients whose clocks are behind.
+        self.tempo_map.prune(self.clock.get_time() - tempo_change_delay)
+        self.update_server_state(post=True)
+
+    def set_room_clock(self, room_clock):
+        """
+        Follow the room's clock, which counts seconds from the room's epoch on the server's clock.
+        Until it's known, cursors follow this client's own clock.
+        """
+        self.clock = room_clock
+        self.sched.clock = room_clock
+
     def on_update(self):
-        self.cursors.on_update()
+        self.sched.on_update()
+
+        tick = self.sched.get_tick()
+        for cursor in self.cursors.objects:
+            cursor.on_update(tick)
 
     def update_touch_points(self, touch_points):
         self.touch_points[self.cid] = touch_points
@@ -211,37 +324,68 @@ class TempoCursorHandler(object):
         cur_time = self.clock.get_time()
         cur_tick = self.tempo_map.time_to_tick(cur_time)
         info = 'delete mode: {}\n\n'.format(self.delete_mode[self.cid])
-        info += 'tempo: {}\n'.format(self.tempo)
+        info += 'tempo: {}{}\n'.format(self.tempo, ' (paused)' if self.is_paused() else '')
+        info += 'tempo curve: {}\n'.format(self.tempo_curve[self.cid])
         return info
 
-    def update_server_state(self, post=False):
-        """Update server state. If post is True, relay this updated state to all clients."""
-        state = {
+    def get_state(self):
+        """Returns this module's syncable state, keyed by field."""
+        return {
             'touch_points': self.touch_points,
             'delete_mode': self.delete_mode,
-            'tempo': self.tempo
+            'tempo_curve': self.tempo_curve,
+            'tempo': self.tempo,
+            'tempo_changes': self.tempo_map.changes
         }
-        data = {'module': self.module_name, 'cid': self.cid, 'state': state, 'post': post}
+
+    def set_state(self, state):
+        self.touch_points = state['touch_points']
+        self.delete_mode = state['delete_mode']
+        self.tempo_curve = state['tempo_curve']
+        self.tempo = state['tempo']
+        self.tempo_map = TempoMap(self.tempo, state['tempo_changes'])
+        self.sched.tempo_map = self.tempo_map
+
+    def update_server_state(self, post=False):
+        """
+        Send the fields of this client's state that changed since the last update to the server.
+        If post is True, relay the changes to all clients.
+        """
+        deltas = client_deltas(self.cid, self.get_state(), self.sent)
+        if not deltas:
+            return
+        data = {'module': self.module_name, 'cid': self.cid, 'deltas': deltas, 'post': post}
         self.client.emit('update_state', data)
 
-    def update_client_state(self, cid, state):
-        """Update this handler's state."""
+    def update_client_state(self, cid, deltas):
+        """Apply another client's state deltas to this handler's state."""
         if cid != self.cid: # this client already updated its own state
-            self.touch_points = state['touch_points']
-            self.delete_mode = state['delete_mode']
+            state = self.get_state()
+            apply_deltas(state, deltas, self.sent)
             self.tempo = state['tempo']
+            self.tempo_map.set_changes(state['tempo_changes'])
+
+    def resync_state(self, state, version):
+        """Replace this handler's state with the server's copy after missing a delta."""
+        keep_client_entries(state, self.get_state(), self.cid)
+        self.set_state(state)
+        self.version = version
 
-    def sync_state(self, state):
+    def sync_state(self, state, version):
         """
         Initial sync with the server's copy of module state.
         """
-        self.touch_points = state['touch_points']
-        self.delete_mode = state['delete_mode']
-        self.tempo = state['tempo']
+        self.set_state(state)
+        self.version = version
+
+        # the room's tempo came from the server, so there's no need to send it back
+        self.sent['tempo'] = self.tempo
+        self.sent['tempo_changes'] = copy.deepcopy(self.tempo_map.changes)
 
         # after initial sync, add default values for this client
         self.touch_points[self.cid] = []
         self.delete_mode[self.cid] = False
+        self.tempo_curve[self.cid] = 'step'
 
         # update server with these default values
         # post=True here because we want all other clients' states to update with this client's
@@ -0,0 +1,66 @@
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Rectangle
+from kivy.graphics.instructions import InstructionGroup
+
+class LabelCache(object):
+    """
+    Rendered text textures, keyed by (text, font size). Rendering a label lays out its text and
+    uploads a new texture, which is too slow to do on every bubble collision, so labels that show a
+    handful of different strings share one texture per string instead.
+    """
+    def __init__(self, texts=(), font_size=None):
+        """
+        :param texts: strings to render up front
+        :param font_size: font size of those strings, or None for Kivy's default
+        """
+        self.textures = {}
+        for text in texts:
+            self.get(text, font_size)
+
+    def get(self, text, font_size=None):
+        """Returns the texture of text at the given font size, rendering it the first time."""
+
+        key = (text, font_size)
+        texture = self.textures.get(key)
+        if texture is None:
+            options = {} if font_size is None else {'font_size': font_size}
+            label = CoreLabel(text=text, **options)
+            label.refresh()
+            texture = label.texture
+            self.textures[key] = texture
+        return texture
+
+class CachedLabel(InstructionGroup):
+    """
+    A label centered at cpos whose textures come from a LabelCache, so that set_text only swaps
+    textures. Can stand in for CLabelRect.
+    """
+    def __init__(self, cache, cpos, text, font_size=None):
+        """
+        :param cache: the LabelCache to take textures from
+        :param cpos: center position
+        :param text: text to show
+        :param font_size: font size, or None for Kivy's default
+        """
+        super(CachedLabel, self).__init__()
+
+        self.cache = cache
+        self.font_size = font_size
+        self.cpos = cpos
+        self.text = None
+        self.rect = Rectangle()
+        self.add(self.rect)
+        self.set_text(text)
+
+    def set_text(self, text):
+        if text == self.text:
+            return
+        self.text = text
+        texture = self.cache.get(text, self.font_size)
+        self.rect.texture = texture
+        self.rect.size = texture.size
+        self.set_cpos(self.cpos)
+
+    def set_cpos(self, cpos):
+        self.cpos = cpos
+        self.rect.pos = (cpos[0] - self.rect.size[0] / 2, cpos[1] - self.rect.size[1] / 2)
@@ -0,0 +1,447 @@
+import hashlib
+
+import numpy as np
+
+from protocol import tick_rate
+
+downwards_gravity = np.array((0, -1800))
+damping_factor = 0.85
+
+# the world advances in fixed steps (ticks) of step_size seconds, whatever the frame rate. after a
+# hitch, at most max_lag seconds are simulated to catch up, and a bubble bounces at most
+# max_hits_per_step times in one step.
+step_size = 1 / tick_rate
+max_lag = 0.25
+max_hits_per_step = 4
+
+# in lockstep, positions and velocities are rounded to multiples of quantum (times the world's
+# scale) after every tick, so that tiny floating point differences between clients can't grow
+quantum = 1 / 64
+
+class BubbleWorld(object):
+    """
+    Physics engine for every PhysicsBubble in a sandbox. Instead of each bubble owning its own
+    position and velocity, the world stores all bubbles' state in contiguous arrays indexed by
+    slot, and integrates and resolves collisions for all of them with a handful of vectorized
+    operations per frame. PhysicsBubble is a view onto one slot.
+    """
+    def __init__(self, capacity=64, scale=1):
+        """
+        :param capacity: initial number of slots, which grows as needed
+        :param scale: size of the sandbox relative to its full size (see Normalizer). gravity and
+            quantum are scaled to match, so that worlds of different scales only differ by scale.
+        """
+        self.scale = scale
+        self.gravity_accel = downwards_gravity * scale
+
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.r = np.zeros(capacity)
+        self.gravity = np.zeros(capacity, dtype=bool)
+        self.bounces = np.zeros(capacity, dtype=int)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.spent = np.full(capacity, -1) # tick each bubble ran out of bounces on, or -1
+
+        # unused slots, popped from the end so that low slots are reused first
+        self.free = list(range(capacity - 1, -1, -1))
+
+        self.tick = 0 # number of steps simulated so far
+        self.time = 0 # seconds simulated so far
+        self.bubble_collisions = False # whether or not bubbles bounce off of each other
+        self.lockstep = False # whether or not state is quantized after every step
+        self.accumulator = 0 # frame time not yet simulated, always less than step_size
+
+        # if set, bubbles are removed this many ticks after they run out of bounces. lockstep
+        # worlds remove bubbles here rather than on the frame clock, since the order that slots
+        # are freed and reused in must be the same for every client.
+        self.expire_ticks = None
+
+    def add(self, pos, vel, r, bounces, gravity=False):
+        """
+        Add a bubble to the world and return its slot.
+        :param pos: initial position
+        :param vel: initial velocity
+        :param r: radius
+        :param bounces: number of collisions left before the bubble stops colliding
+        :param gravity: whether or not the bubble is subjected to downwards gravity
+        """
+        if not self.free:
+            self.grow()
+        slot = self.free.pop()
+        self.pos[slot] = pos
+        self.vel[slot] = vel
+        self.r[slot] = r
+        self.bounces[slot] = bounces
+        self.gravity[slot] = gravity
+        self.alive[slot] = True
+        self.spent[slot] = -1
+        return slot
+
+    def remove(self, slot):
+        self.alive[slot] = False
+        self.vel[slot] = 0
+        self.spent[slot] = -1
+        self.free.append(slot)
+
+    def grow(self):
+        """Double the capacity of every array."""
+        capacity = len(self.alive)
+        self.pos = np.concatenate((self.pos, np.zeros((capacity, 2))))
+        self.vel = np.concatenate((self.vel, np.zeros((capacity, 2))))
+        self.r = np.concatenate((self.r, np.zeros(capacity)))
+        self.gravity = np.concatenate((self.gravity, np.zeros(capacity, dtype=bool)))
+        self.bounces = np.concatenate((self.bounces, np.zeros(capacity, dtype=int)))
+        self.alive = np.concatenate((self.alive, np.zeros(capacity, dtype=bool)))
+        self.spent = np.concatenate((self.spent, np.full(capacity, -1)))
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1)) + self.free
+
+    def is_moving(self, slot):
+        return np.any(self.vel[slot] != 0)
+
+    def step(self, dt, bounds, grid):
+        """
+        Advance the world by dt seconds of frame time, in fixed steps of step_size seconds. Time
+        that doesn't fill a whole step is carried over to the next call.
+        :param dt: frame time in seconds
+        :param bounds: (left, bottom, right, top) of the sandbox
+        :param grid: BlockGrid of the SoundBlocks that bubbles bounce off of
+        Returns a list of (slot, block, time) collisions, where block is None for sandbox edges and
+        other bubbles, and time is the world time of the impact (see self.time).
+        """
+        self.accumulator = min(self.accumulator + dt, max_lag)
+        collisions = []
+        while self.accumulator >= step_size:
+            collisions += self.substep(bounds, grid)
+            self.accumulator -= step_size
+        return collisions
+
+    def substep(self, bounds, grid):
+        """
+        Advance every bubble by one fixed step. Each bubble is swept along its path to its first
+        impact with a block or sandbox edge, bounced, and swept again for the rest of the step, so
+        bubbles can't tunnel through thin blocks no matter how fast they move.
+        """
+        alive = self.alive
+        self.vel[alive & self.gravity] += self.gravity_accel * step_size
+
+        # a bubble that has stopped without gravity would never make a sound, so it's out of
+        # bounces. this is decided here rather than by its view so that it happens on the same
+        # tick for every client in lockstep.
+        stopped = alive & ~self.gravity & np.all(self.vel == 0, axis=1)
+        self.bounces[stopped] = np.minimum(self.bounces[stopped], 0)
+
+        remaining = np.where(alive, step_size, 0.0) # seconds of motion left in this step
+
+        collisions = []
+        for _ in range(max_hits_per_step):
+            # only bubbles with bounces left collide
+            slots = np.flatnonzero((remaining > 0) & (self.bounces > 0))
+            if not len(slots):
+                break
+            t, normal, blocks = self.first_hits(slots, remaining[slots], bounds, grid)
+
+            # move every bubble up to its first impact, or through the rest of the step
+            hit = t < np.inf
+            t = np.where(hit, t, remaining[slots])
+            self.pos[slots] += self.vel[slots] * t[:, None]
+            remaining[slots] -= t
+
+            slots, normal = slots[hit], normal[hit]
+            blocks = [block for block, block_hit in zip(blocks, hit) if block_hit]
+            if not len(slots):
+                break
+            vel = self.vel[slots]
+            vel -= 2 * np.sum(vel * normal, axis=1)[:, None] * normal
+
+            # sandbox edges clamp bubbles that started outside of them, and the floor absorbs some
+            # of a falling bubble's speed
+            edges = np.array([block is None for block in blocks], dtype=bool)
+            left, bottom, right, top = bounds
+            r = self.r[slots[edges], None]
+            self.pos[slots[edges]] = np.clip(
+                self.pos[slots[edges]], np.array((left, bottom)) + r, np.array((right, top)) - r
+            )
+            floor = edges & (normal[:, 1] > 0) & self.gravity[slots]
+            vel[floor, 1] *= damping_factor
+
+            self.vel[slots] = vel
+            self.bounces[slots] -= 1
+            times = self.time + step_size - remaining[slots]
+            collisions += list(zip(slots, blocks, times))
+
+        # bubbles without bounces left (or that hit max_hits_per_step) finish the step unhindered
+        self.pos[alive] += self.vel[alive] * remaining[alive, None]
+
+        if self.bubble_collisions:
+            collisions += self.collide_bubbles()
+
+        if self.lockstep:
+            self.quantize()
+        if self.expire_ticks is not None:
+            self.expire()
+        self.tick += 1
+        self.time = self.tick * step_size
+        return collisions
+
+    def expire(self):
+        """Remove bubbles that ran out of bounces at least expire_ticks ticks ago."""
+        spent = self.alive & (self.bounces <= 0)
+        self.spent[spent & (self.spent < 0)] = self.tick
+        for slot in np.flatnonzero(spent & (self.tick - self.spent >= self.expire_ticks)).tolist():
+            self.remove(slot)
+
+    def quantize(self):
+        q = quantum * self.scale
+        self.pos = np.round(self.pos / q) * q
+        self.vel = np.round(self.vel / q) * q
+
+    def to_units(self, values, origin=(0, 0)):
+        """
+        Converts positions (relative to origin) or velocities to integer multiples of quantum,
+        which are the same for worlds of any scale.
+        """
+        return np.round((np.asarray(values) - origin) / (quantum * self.scale)).astype(np.int64)
+
+    def from_units(self, units, origin=(0, 0)):
+        return np.asarray(units, dtype=float) * (quantum * self.scale) + origin
+
+    def state_hash(self, slots, origin):
+        """
+        Returns a hash of the given bubbles' physics state, in the given order.
+        :param slots: slots of the bubbles to hash
+        :param origin: bottom left of the sandbox, so that the hash doesn't depend on window layout
+        """
+        slots = np.asarray(slots, dtype=int)
+        state = np.concatenate((
+            self.to_units(self.pos[slots], origin),
+            self.to_units(self.vel[slots]),
+            self.bounces[slots, None].astype(np.int64)
+        ), axis=1)
+        return hashlib.sha1(state.tobytes()).hexdigest()[:16]
+
+    def bubble_pairs(self, slots):
+        """
+        Sort-and-sweep broadphase over the given bubbles: sorted by the left edge of their bounds,
+        each bubble is paired with the following bubbles whose left edge comes before its right
+        edge. Returns (a, b) arrays of the slots of each overlapping pair.
+        """
+        order = slots[np.argsort(self.pos[slots, 0] - self.r[slots], kind='stable')]
+        lo = self.pos[order, 0] - self.r[order]
+        hi = self.pos[order, 0] + self.r[order]
+        n = len(order)
+
+        # bubbles i + 1 through end[i] - 1 overlap bubble i along x
+        end = np.searchsorted(lo, hi, side='right')
+        counts = np.maximum(end - np.arange(n) - 1, 0)
+        i = np.repeat(np.arange(n), counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        j = i + 1 + np.arange(len(i)) - starts
+        a, b = order[i], order[j]
+
+        d = self.pos[b] - self.pos[a]
+        touching = np.sum(d * d, axis=1) < (self.r[a] + self.r[b]) ** 2
+        return a[touching], b[touching]
+
+    def collide_bubbles(self):
+        """
+        Elastic collisions between touching bubbles that are moving towards each other, with mass
+        proportional to area. Each collision costs both bubbles a bounce.
+        """
+        slots = np.flatnonzero(self.alive & (self.bounces > 0))
+        a, b = self.bubble_pairs(slots)
+
+        d = self.pos[b] - self.pos[a]
+        dist = np.sqrt(np.sum(d * d, axis=1))
+        normal = d / np.maximum(dist, 1e-9)[:, None]
+        closing = np.sum((self.vel[a] - self.vel[b]) * normal, axis=1)
+        approaching = closing > 0
+        a, b = a[approaching], b[approaching]
+        normal, closing, dist = normal[approaching], closing[approaching], dist[approaching]
+
+        mass_a, mass_b = self.r[a] ** 2, self.r[b] ** 2
+        impulse = (2 * closing / (mass_a + mass_b))[:, None] * normal
+        overlap = (self.r[a] + self.r[b] - dist)[:, None] * normal
+        share_a = (mass_b / (mass_a + mass_b))[:, None]
+
+        # a bubble in several collisions at once gets the sum of their impulses
+        np.add.at(self.vel, a, -impulse * mass_b[:, None])
+        np.add.at(self.vel, b, impulse * mass_a[:, None])
+        np.add.at(self.pos, a, -overlap * share_a)
+        np.add.at(self.pos, b, overlap * (1 - share_a))
+        np.subtract.at(self.bounces, a, 1)
+        np.subtract.at(self.bounces, b, 1)
+
+        time = self.time + step_size
+        return [(slot, None, time) for pair in zip(a, b) for slot in pair]
+
+    def first_hits(self, slots, t_max, bounds, grid):
+        """
+        Finds the first impact of each bubble within t_max seconds.
+        :param slots: array of bubble slots
+        :param t_max: array of how far ahead to look for each bubble, in seconds
+        Returns (t, normal, blocks): the time until each bubble's impact (inf if there isn't one),
+        the unit normal of the surface it hits, and the block it hits (None for sandbox edges).
+        """
+        pos, vel, r = self.pos[slots], self.vel[slots], self.r[slots]
+        t, normal = sweep_walls(pos, vel, r, bounds, t_max)
+        blocks = [None] * len(slots)
+
+        # candidate blocks near each bubble's path
+        pairs, candidates = [], []
+        end = pos + vel * t_max[:, None]
+        lo = (np.minimum(pos, end) - r[:, None]).tolist()
+        hi = (np.maximum(pos, end) + r[:, None]).tolist()
+        for i, ((left, bottom), (right, top)) in enumerate(zip(lo, hi)):
+            for block in grid.query(left, bottom, right, top):
+                pairs.append(i)
+                candidates.append(block)
+        if not pairs:
+            return t, normal, blocks
+
+        pairs = np.array(pairs)
+        pair_t, pair_normal = sweep_blocks(
+            pos[pairs], vel[pairs], r[pairs], grid.bounds_of(candidates), t_max[pairs]
+        )
+
+        # keep the earliest impact of each bubble, preferring blocks over edges on ties. pairs
+        # are in block insertion order, so ties between blocks go to the older block.
+        order = np.lexsort((np.arange(len(pairs)), pair_t, pairs))
+        bubbles, first = np.unique(pairs[order], return_index=True)
+        best = order[first]
+        earlier = (pair_t[best] < np.inf) & (pair_t[best] <= t[bubbles])
+        for i, j in zip(bubbles[earlier], best[earlier]):
+            t[i], normal[i], blocks[i] = pair_t[j], pair_normal[j], candidates[j]
+        return t, normal, blocks
+
+def sweep_walls(pos, vel, r, bounds, t_max):
+    """
+    Sweeps circles against the inside of the sandbox edges. Circles that are already past an edge
+    and moving further out hit it immediately.
+    Returns (t, normal) of each circle's first impact within t_max, with t = inf for no impact.
+    """
+    left, bottom, right, top = bounds
+    t = np.full(len(pos), np.inf)
+    normal = np.zeros((len(pos), 2))
+    edges = (
+        (1, bottom + r, (0, 1)),
+        (1, top - r, (0, -1)),
+        (0, left + r, (1, 0)),
+        (0, right - r, (-1, 0))
+    )
+    for axis, limit, edge_normal in edges:
+        toward = vel[:, axis] * edge_normal[axis] < 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            edge_t = np.maximum((limit - pos[:, axis]) / vel[:, axis], 0)
+        mask = toward & (edge_t <= t_max) & (edge_t < t)
+        t[mask] = edge_t[mask]
+        normal[mask] = edge_normal
+    return t, normal
+
+def sweep_blocks(pos, vel, r, bounds, t_max):
+    """
+    Swept circle vs. AABB test for pairs of moving circles and blocks. The circle hits the block
+    when its center hits the block expanded by r with rounded corners, so the center's path is
+    tested against the expanded block (slab test), and against the corner circle when it enters
+    the expanded block in a corner region.
+    :param bounds: array of (left, bottom, right, top) of each pair's block
+    Returns (t, normal) of each pair's impact within t_max, with t = inf for no impact.
+    """
+    lo = bounds[:, :2] - r[:, None]
+    hi = bounds[:, 2:] + r[:, None]
+
+    # time at which the center enters and leaves the expanded block along each axis. circles that
+    # aren't moving along an axis are either always or never within the block along it.
+    moving = vel != 0
+    inside = (pos >= lo) & (pos <= hi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (lo - pos) / vel
+        t2 = (hi - pos) / vel
+    t_in = np.where(moving, np.minimum(t1, t2), np.where(inside, -np.inf, np.inf))
+    t_out = np.where(moving, np.maximum(t1, t2), np.where(inside, np.inf, -np.inf))
+
+    axis = np.argmax(t_in, axis=1)
+    rows = np.arange(len(pos))
+    t_enter = t_in[rows, axis]
+    t_exit = np.min(t_out, axis=1)
+    # circles that start overlapping a block are left alone, so they can move out of it
+    hit = (t_enter >= 0) & (t_enter <= t_exit) & (t_enter <= t_max)
+
+    t = np.where(hit, t_enter, np.inf)
+    normal = np.zeros((len(pos), 2))
+    normal[rows, axis] = -np.sign(vel[rows, axis])
+
+    # entry points beyond the block along both axes are in a corner region of the expanded block
+    point = pos + vel * np.where(hit, t_enter, 0)[:, None]
+    outside = (point < bounds[:, :2]) | (point > bounds[:, 2:])
+    corner = hit & outside[:, 0] & outside[:, 1]
+    if np.any(corner):
+        c = np.where(point[corner] < bounds[corner, :2], bounds[corner, :2], bounds[corner, 2:])
+        d = pos[corner] - c
+        v = vel[corner]
+        a = np.sum(v * v, axis=1)
+        b = np.sum(d * v, axis=1)
+        disc = b * b - a * (np.sum(d * d, axis=1) - r[corner] ** 2)
+        with np.errstate(invalid='ignore'):
+            corner_t = (-b - np.sqrt(disc)) / a
+        corner_hit = (disc >= 0) & (corner_t >= 0) & (corner_t <= t_max[corner])
+
+        corner_t = np.where(corner_hit, corner_t, np.inf)
+        t[corner] = corner_t
+        normal[corner] = np.where(
+            corner_hit[:, None], (d + v * np.where(corner_hit, corner_t, 0)[:, None]), 0
+        ) / r[corner, None]
+    return t, normal
+
+class BlockGrid(object):
+    """
+    Uniform grid over the sandbox that indexes SoundBlocks by the cells their bounds overlap, so
+    that collision checks only look at blocks near a bubble. SoundBlockHandler keeps it up to date
+    as blocks are added and deleted.
+    """
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        self.cells = {} # blocks overlapping each cell, keyed by (column, row)
+        self.bounds = {} # (left, bottom, right, top) of each block, keyed by block
+
+        # insertion order of each block, so that queries return blocks in a stable order
+        self.order = {}
+        self.count = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def cell_range(self, left, bottom, right, top):
+        c = self.cell_size
+        for col in range(int(left // c), int(right // c) + 1):
+            for row in range(int(bottom // c), int(top // c) + 1):
+                yield (col, row)
+
+    def bounds_of(self, blocks):
+        """Returns an array of (left, bottom, right, top) of each block."""
+        return np.array([self.bounds[block] for block in blocks], dtype=float)
+
+    def insert(self, block):
+        left, bottom = block.pos
+        right, top = block.pos + block.size
+        self.bounds[block] = (left, bottom, right, top)
+        self.order[block] = self.count
+        self.count += 1
+        for cell in self.cell_range(left, bottom, right, top):
+            self.cells.setdefault(cell, []).append(block)
+
+    def remove(self, block):
+        for cell in self.cell_range(*self.bounds.pop(block)):
+            self.cells[cell].remove(block)
+            if not self.cells[cell]:
+                del self.cells[cell]
+        del self.order[block]
+
+    def query(self, left, bottom, right, top):
+        """Returns the blocks whose bounds overlap the given bounds, in insertion order."""
+        found = set()
+        for cell in self.cell_range(left, bottom, right, top):
+            for block in self.cells.get(cell, ()):
+                l, b, r, t = self.bounds[block]
+                if l <= right and left <= r and b <= top and bottom <= t:
+                    found.add(block)
+        return sorted(found, key=self.order.get)
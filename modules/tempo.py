@@ -0,0 +1,138 @@
+import bisect
+import math
+
+from common.clock import kTicksPerQuarter
+
+# ways the tempo can get from one change to the next: 'step' holds it until the next change, while
+# 'linear' and 'exp' ramp it to the next change's tempo linearly or exponentially over time
+curves = ['step', 'linear', 'exp']
+
+def ticks_per_second(bpm):
+    return bpm / 60 * kTicksPerQuarter
+
+class TempoMap(object):
+    """
+    Converts between a room's time and its ticks when the tempo changes over time. The map is a
+    list of [tick, time, bpm, curve] changes, sorted by time, each of which starts a segment that
+    lasts until the next change. The segment's curve says how the tempo gets from the change's bpm
+    to the next change's (see curves). A bpm of 0 pauses the room's ticks.
+
+    The ticks and times of the changes are kept in sorted tables, so that both conversions find
+    their segment with a bisect, however many changes there are.
+
+    Every client builds the same map from the same changes, which are picked by the client that
+    changed the tempo (see TempoCursorHandler.change_tempo), so their ticks agree.
+    """
+    def __init__(self, bpm=60, changes=None):
+        """
+        :param bpm: tempo from the start of the room, if there are no changes
+        :param changes: list of [tick, time, bpm] or [tick, time, bpm, curve] changes
+        """
+        self.set_changes(changes or [[0, 0, bpm]])
+
+    def set_changes(self, changes):
+        changes = [list(change) + ['step'] * (4 - len(change)) for change in changes]
+        self.changes = sorted(changes, key=lambda change: change[1])
+        self.ticks = [change[0] for change in self.changes]
+        self.times = [change[1] for change in self.changes]
+
+    def add_change(self, tick, time, bpm, curve='step'):
+        """
+        Change the tempo to bpm from the given tick and time, replacing any later changes.
+        :param curve: how the tempo gets from bpm to that of the next change, if one is added later
+        """
+        index = bisect.bisect_left(self.times, time)
+        changes = self.changes[:index]
+
+        # a ramp that's still going at time ends there, at the tempo it has reached, so that it
+        # keeps its slope and the ticks before time stay where they were
+        if changes and changes[-1][3] != 'step' and index < len(self.changes):
+            changes.append([self.time_to_tick(time), time, self.get_tempo(time), 'step'])
+        self.set_changes(changes + [[tick, time, bpm, curve]])
+
+    def add_ramp(self, time, end_time, bpm, curve='linear'):
+        """
+        Ramp the tempo from whatever it is at time to bpm at end_time, replacing any later changes.
+        :param curve: 'linear' or 'exp'
+        """
+        tick, start_bpm = self.time_to_tick(time), self.get_tempo(time)
+        index = bisect.bisect_left(self.times, time)
+        self.set_changes(self.changes[:index] + [[tick, time, start_bpm, curve],
+                                                 [tick, end_time, bpm, 'step']])
+
+        # the ramp's end tick is wherever the ramp gets to by end_time
+        self.changes[-1][0] = self.ticks[-1] = self.tick_in_segment(len(self.changes) - 2, end_time)
+
+    def prune(self, time):
+        """Drop the changes before the segment that time is in, since they're in the past."""
+        index = self.segment_at_time(time)
+        if index:
+            self.set_changes(self.changes[index:])
+
+    def segment(self, index):
+        """
+        Returns (tick, time, start bpm, end bpm, duration, curve) of the segment starting at the
+        given change. The last segment, and any that can't ramp, hold their tempo forever.
+        """
+        tick, time, bpm, curve = self.changes[index]
+        if index + 1 == len(self.changes) or curve == 'step':
+            return tick, time, bpm, bpm, math.inf, 'step'
+        end_bpm, duration = self.changes[index + 1][2], self.changes[index + 1][1] - time
+        if curve == 'exp' and (bpm <= 0 or end_bpm <= 0):
+            curve = 'linear' # exponential ramps can't reach or leave a pause
+        if bpm == end_bpm or duration <= 0:
+            curve = 'step'
+        return tick, time, bpm, end_bpm, duration, curve
+
+    def segment_at_time(self, time):
+        return max(bisect.bisect_right(self.times, time) - 1, 0)
+
+    def get_tempo(self, time):
+        tick, start, bpm, end_bpm, duration, curve = self.segment(self.segment_at_time(time))
+        t = min(max(time - start, 0), duration)
+        if curve == 'linear':
+            return bpm + (end_bpm - bpm) * t / duration
+        if curve == 'exp':
+            return bpm * (end_bpm / bpm) ** (t / duration)
+        return bpm
+
+    def time_to_tick(self, time):
+        return self.tick_in_segment(self.segment_at_time(time), time)
+
+    def tick_in_segment(self, index, time):
+        tick, start, bpm, end_bpm, duration, curve = self.segment(index)
+        t = time - start
+        if curve == 'linear':
+            # the tempo is bpm + slope * t, so ticks are its integral
+            slope = (end_bpm - bpm) / duration
+            t = min(t, duration)
+            return tick + ticks_per_second(bpm * t + slope * t * t / 2)
+        if curve == 'exp':
+            # the tempo is bpm * e^(rate * t)
+            rate = math.log(end_bpm / bpm) / duration
+            t = min(t, duration)
+            return tick + ticks_per_second(bpm * math.expm1(rate * t) / rate)
+        return tick + ticks_per_second(bpm) * t
+
+    def tick_to_time(self, tick):
+        """Returns the first time at which the room reaches tick, or inf if it never does."""
+
+        # a change on exactly this tick is the first time it's reached, even if the room paused
+        # there and resumed later on the same tick
+        index = bisect.bisect_left(self.ticks, tick)
+        if index < len(self.ticks) and self.ticks[index] == tick:
+            return self.times[index]
+
+        index = max(bisect.bisect_right(self.ticks, tick) - 1, 0)
+        start_tick, start, bpm, end_bpm, duration, curve = self.segment(index)
+        beats = (tick - start_tick) / ticks_per_second(60) # beats into the segment
+        if curve == 'linear':
+            # solve bpm * t + slope * t^2 / 2 = 60 * beats for t
+            slope = (end_bpm - bpm) / duration
+            return start + 2 * 60 * beats / (bpm + math.sqrt(bpm * bpm + 2 * slope * 60 * beats))
+        if curve == 'exp':
+            rate = math.log(end_bpm / bpm) / duration
+            return start + math.log1p(rate * 60 * beats / bpm) / rate
+        if bpm == 0:
+            return math.inf
+        return start + 60 * beats / bpm
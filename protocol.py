@@ -0,0 +1,256 @@
+"""
+Helpers for the messages that client.py and server.py exchange.
+
+Module state is a dict of fields. Most fields are per-client dicts keyed by client id (e.g. each
+user's PhysicsBubble pitch), while a few are room-wide values (e.g. TempoCursor's tempo). Instead
+of sending whole state dicts around, clients send deltas: (cid, field, value) tuples, where cid is
+None for room-wide fields.
+"""
+import copy
+import json
+import struct
+
+def client_deltas(cid, state, sent):
+    """
+    Find the entries of a client's module state that changed since they were last sent.
+    :param cid: the client's id
+    :param state: dict of module state, mapping field -> {cid: value} or field -> value
+    :param sent: dict mapping field -> last sent value, updated in place
+    """
+    deltas = []
+    for field, values in state.items():
+        if isinstance(values, dict):
+            if cid not in values:
+                continue
+            key, value = cid, values[cid]
+        else:
+            key, value = None, values
+
+        if field not in sent or sent[field] != value:
+            # copy so that in-place edits (e.g. a list of touch points) still show up as changes
+            sent[field] = copy.deepcopy(value)
+            deltas.append((key, field, value))
+    return deltas
+
+def apply_deltas(state, deltas, sent=None):
+    """
+    Apply (cid, field, value) deltas to a module state in place.
+    :param state: dict of module state
+    :param deltas: iterable of (cid, field, value), where cid is None for room-wide fields
+    :param sent: optional sent dict (see client_deltas). room-wide values that came from another
+        client are recorded here so that they aren't echoed back as our own change.
+    """
+    for cid, field, value in deltas:
+        if cid is None:
+            state[field] = value
+            if sent is not None:
+                sent[field] = copy.deepcopy(value)
+        else:
+            state[field][cid] = value
+
+def keep_client_entries(state, own_state, cid):
+    """
+    Overwrite a client's entries in a freshly synced state with its current local values, since
+    the server may not have applied that client's latest deltas yet.
+    """
+    for field, values in state.items():
+        if isinstance(values, dict) and cid in own_state.get(field, {}):
+            values[cid] = own_state[field][cid]
+
+# events are sent in frames, i.e. batches of [event, data] pairs with a sequence number, that are
+# flushed once per tick. see FrameSender in client.py, flush_frame() in server.py, and
+# pack_json_frame() and CompactCodec.encode_frame() for the two ways that frames are encoded.
+frame_events = [
+    'touch_down', 'touch_move', 'touch_up', 'key_down', 'update_state', 'state_hash', 'snapshot',
+    'clock_report'
+]
+
+# rooms either let every client simulate bubbles on its own ('local'), or run a deterministic
+# lockstep simulation ('lockstep'): every client advances the same fixed ticks of physics from the
+# room's epoch, and bubbles are released on a tick stamped by the server, lockstep_delay ticks in
+# the future so that the release reaches every client in time. every hash_interval ticks, clients
+# report a hash of their physics state, and clients that disagree with the majority are corrected
+# with a snapshot from a client that agrees.
+physics_modes = ['local', 'lockstep', 'server']
+tick_rate = 120 # physics ticks per second
+lockstep_delay = 18
+hash_interval = 60
+
+# in the 'server' mode, the server simulates bubbles itself (see simulation.py), on the worker that
+# owns the room, with touches taking effect server_delay ticks after they arrive so that the bus
+# has time to deliver them to the owner. a touch that arrives later takes effect late. the server
+# streams snapshots of every bubble's position, which clients draw interp_delay ticks in the past
+# so that they always have a snapshot on either side to interpolate between.
+server_delay = 2
+interp_delay = 18
+
+# clients estimate the offset between their clock and the server's like NTP does: every
+# clock_sync_interval seconds they send a clock_ping, which the server answers right away with the
+# times it received and answered it. the offset is taken from whichever of the last
+# clock_sync_samples exchanges had the shortest round trip, and is within half of that round trip
+# of the truth. every drift_report_interval seconds, clients report how accurate their clock is.
+clock_sync_interval = 2
+clock_sync_samples = 8
+drift_report_interval = 10
+
+# tempo changes take effect on the first beat at least tempo_change_delay seconds after they're
+# picked, so that they reach every client in the room in time
+tempo_change_delay = 0.5
+
+# compact encoding for hot events (touches and key presses), negotiated per client. modules and
+# clients are referred to by small integer ids, and positions are sandbox-relative (u, v)
+# coordinates packed as fixed-point 16-bit integers, so each touch event is 8 bytes. in a compact
+# frame, every other event (including hot events with extra fields) is sent as a JSON record.
+module_names = ['PhysicsBubble', 'SoundBlock', 'TempoCursor']
+compact_events = ['touch_down', 'touch_move', 'touch_up', 'key_down']
+compact_fields = {'cid', 'module', 'pos', 'key'}
+touch_format = struct.Struct('<BBHhh') # event id, module id, peer id, u, v
+key_format = struct.Struct('<BBHB') # event id, module id, peer id, length of key name
+position_scale = 8192 # fixed-point units per sandbox width, so u and v can range from -4 to 4
+frame_header = struct.Struct('<I') # sequence number
+record_header = struct.Struct('<H') # length of the record that follows
+long_record = 0xffff # record length that means the real length follows as a long_record_header
+long_record_header = struct.Struct('<I') # length of a record too long for record_header
+json_record = 255 # event id of records holding a JSON-encoded [event, data] pair
+snapshot_header = struct.Struct('<IH') # tick, number of bubbles
+snapshot_record = struct.Struct('<Ihhh') # bubble id, u, v, bounces
+
+def encode_snapshot(tick, bubbles):
+    """
+    Packs a snapshot of bubbles streamed by the server. Positions are packed like touch positions.
+    :param tick: room tick of the snapshot
+    :param bubbles: list of (id, (u, v), bounces)
+    """
+    parts = [snapshot_header.pack(tick, len(bubbles))]
+    for bubble_id, (u, v), bounces in bubbles:
+        u = min(max(int(round(u * position_scale)), -32768), 32767)
+        v = min(max(int(round(v * position_scale)), -32768), 32767)
+        bounces = min(max(bounces, -32768), 32767)
+        parts.append(snapshot_record.pack(bubble_id, u, v, bounces))
+    return b''.join(parts)
+
+def decode_snapshot(packet):
+    """Returns (tick, bubbles), in the same form as encode_snapshot's arguments."""
+    tick, count = snapshot_header.unpack_from(packet)
+    bubbles = []
+    for i in range(count):
+        offset = snapshot_header.size + i * snapshot_record.size
+        bubble_id, u, v, bounces = snapshot_record.unpack_from(packet, offset)
+        bubbles.append((bubble_id, (u / position_scale, v / position_scale), bounces))
+    return tick, bubbles
+
+class CompactCodec(object):
+    """
+    Packs and unpacks hot events. Module ids are the indices into module_names, and peer ids are
+    assigned by the server when clients join a room (see set_peers).
+    """
+    def __init__(self):
+        self.module_ids = {name: i for i, name in enumerate(module_names)}
+        self.peer_ids = {} # peer id of each client, keyed by client id
+        self.peers = {} # client id of each peer, keyed by peer id
+
+    def set_peers(self, peer_ids):
+        """:param peer_ids: dict mapping client id -> peer id"""
+        self.peer_ids = dict(peer_ids)
+        self.peers = {pid: cid for cid, pid in self.peer_ids.items()}
+
+    def can_encode(self, event, data):
+        return event in compact_events and data['cid'] in self.peer_ids and \
+            compact_fields.issuperset(data)
+
+    def encode(self, event, data):
+        event_id = compact_events.index(event)
+        module_id = self.module_ids[data['module']]
+        peer_id = self.peer_ids[data['cid']]
+        if event == 'key_down':
+            key = data['key'].encode('utf-8')
+            return key_format.pack(event_id, module_id, peer_id, len(key)) + key
+
+        u = min(max(int(round(data['pos'][0] * position_scale)), -32768), 32767)
+        v = min(max(int(round(data['pos'][1] * position_scale)), -32768), 32767)
+        return touch_format.pack(event_id, module_id, peer_id, u, v)
+
+    def decode(self, packet):
+        """Returns (event, data), with data in the same form as the JSON encoding."""
+        event = compact_events[packet[0]]
+        if event == 'key_down':
+            _, module_id, peer_id, length = key_format.unpack_from(packet)
+            key = packet[key_format.size:key_format.size + length].decode('utf-8')
+            data = {'cid': self.peers[peer_id], 'module': module_names[module_id], 'key': key}
+            return event, data
+
+        _, module_id, peer_id, u, v = touch_format.unpack_from(packet)
+        pos = (u / position_scale, v / position_scale)
+        data = {'cid': self.peers[peer_id], 'module': module_names[module_id], 'pos': pos}
+        return event, data
+
+    def encode_frame(self, seq, events):
+        """
+        :param seq: frame sequence number
+        :param events: list of (event, data) pairs
+        """
+        parts = [frame_header.pack(seq)]
+        for event, data in events:
+            if self.can_encode(event, data):
+                record = self.encode(event, data)
+            else:
+                record = bytes([json_record]) + json.dumps([event, data]).encode('utf-8')
+            # snapshots and large state updates can be longer than record_header can hold
+            if len(record) < long_record:
+                parts.append(record_header.pack(len(record)))
+            else:
+                parts.append(record_header.pack(long_record))
+                parts.append(long_record_header.pack(len(record)))
+            parts.append(record)
+        return b''.join(parts)
+
+    def decode_frame(self, packet):
+        """Returns (seq, events), with events as a list of (event, data) pairs."""
+        seq, = frame_header.unpack_from(packet)
+        offset = frame_header.size
+        events = []
+        while offset < len(packet):
+            length, = record_header.unpack_from(packet, offset)
+            offset += record_header.size
+            if length == long_record:
+                length, = long_record_header.unpack_from(packet, offset)
+                offset += long_record_header.size
+            record = packet[offset:offset + length]
+            offset += length
+            if record[0] == json_record:
+                events.append(tuple(json.loads(record[1:].decode('utf-8'))))
+            else:
+                events.append(self.decode(record))
+        return seq, events
+
+def hot_fields(event):
+    """Returns the fields of a hot event, in the order they're listed in a JSON frame."""
+    return ('cid', 'module', 'key') if event == 'key_down' else ('cid', 'module', 'pos')
+
+def pack_json_frame(seq, events):
+    """
+    Returns a frame for the JSON encoding: [seq, records]. Hot events whose data has just the usual
+    fields are listed as [event, cid, module, pos or key], so their field names aren't repeated in
+    every record. every other event is listed as [event, data].
+    :param seq: frame sequence number
+    :param events: list of (event, data) pairs
+    """
+    records = []
+    for event, data in events:
+        fields = hot_fields(event)
+        if event in compact_events and len(data) == len(fields) and all(f in data for f in fields):
+            records.append([event] + [data[field] for field in fields])
+        else:
+            records.append([event, data])
+    return [seq, records]
+
+def unpack_json_frame(frame):
+    """Returns (seq, events), with events as a list of (event, data) pairs."""
+    seq, records = frame
+    events = []
+    for record in records:
+        if len(record) == 2:
+            events.append(tuple(record))
+        else:
+            events.append((record[0], dict(zip(hot_fields(record[0]), record[1:]))))
+    return seq, events
@@ -1,10 +1,25 @@
+# workers share sockets with the message bus, so everything has to be cooperative
+import eventlet
+eventlet.monkey_patch()
+
+import copy
+import multiprocessing
+from collections import Counter
 import random
 import os
+import time
 
-from flask import Flask
-from flask_socketio import SocketIO, emit
+from flask import Flask, jsonify
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask import request
 
+from bus import make_bus, owner_index, run_broker
+from protocol import apply_deltas, CompactCodec, frame_events, module_names
+from protocol import pack_json_frame, unpack_json_frame
+from protocol import physics_modes, tick_rate, lockstep_delay, hash_interval, server_delay
+from protocol import encode_snapshot
+from simulation import RoomSimulation
+
 # attempt to fix packet 'too many packets in payload' error
 from engineio.payload import Payload
 Payload.max_decode_packets = 500
@@ -12,78 +27,510 @@ Payload.max_decode_packets = 500
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-client_count = 0 # number of clients connected
+# number of worker processes sharing the port. with more than one worker, rooms are shared
+# through a broker process listening on bus_path.
+worker_count = int(os.environ.get('WORKERS', 1))
+bus_path = os.environ.get('BUS_PATH', '/tmp/interval-bus.sock')
+bus = None # this worker's message bus, see run_worker()
+worker_index = 0 # index of this worker, which owns the rooms that bus.owner_index() gives it
+
+# max number of touch_move events relayed per second for each sender. in between flushes, only the
+# latest move from each sender is kept.
+move_rate = float(os.environ.get('MOVE_RATE', 30))
+moves_coalesced = 0 # number of touch_move events dropped in favor of a later one
+
+# outgoing events are batched into one frame per room, sent every frame_interval seconds or as
+# soon as max_frame_events events are waiting
+frame_interval = float(os.environ.get('FRAME_INTERVAL', 0.016))
+max_frame_events = int(os.environ.get('MAX_FRAME_EVENTS', 64))
+
+# number of bubble snapshots streamed per second from rooms that the server simulates
+snapshot_rate = float(os.environ.get('SNAPSHOT_RATE', 20))
+
+# number of seconds an empty room is kept in memory before being evicted
+room_ttl = float(os.environ.get('ROOM_TTL', 600))
+default_room = 'lobby'
+
+class Room(object):
+    """
+    A named session. Every room has its own sandbox, i.e. its own copy of each module's state and
+    tempo, and events are only relayed to the clients in the same room.
+
+    Only the room's owner (see on_bus_message) keeps its state, membership and simulation. Other
+    workers with clients in the room only keep what they need to relay events to them.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state_dict = {
+            'PhysicsBubble': copy.deepcopy(PhysicsBubbleState),
+            'SoundBlock': copy.deepcopy(SoundBlockState),
+            'TempoCursor': copy.deepcopy(TempoCursorState)
+        }
+
+        # version of each module's state, bumped every time deltas are relayed to clients
+        self.version_dict = {module_str: 0 for module_str in self.state_dict}
+
+        self.clients = set() # client ids in this room, across all workers
+
+        # small integer ids for the compact encoding, assigned by the owner in join order and
+        # published to the workers that relay the room's events
+        self.peer_ids = {}
+        self.next_peer_id = 0
+        self.codec = CompactCodec()
+        self.pending_moves = {} # latest unrelayed touch_move data from this worker's clients
+        self.outbox = [] # (event, data) pairs waiting for the next frame to this worker's clients
+        self.frame_seq = 0
+        self.last_active = time.time()
+
+        # physics mode and epoch (start of tick 0) are picked by the first client to join. see
+        # protocol.physics_modes.
+        self.physics = None
+        self.epoch = None
+        self.hashes = {} # lockstep state hash of each client, keyed by tick and then client id
+        self.snapshot_targets = set() # desynced clients waiting for a snapshot, across all workers
+        self.simulation = None # bubble simulation of rooms in the 'server' physics mode
+        self.clock_reports = {} # latest clock accuracy report of each client, keyed by client id
+
+    def is_expired(self, now):
+        return len(self.clients) == 0 and now - self.last_active > room_ttl
+
+    def get_tick(self):
+        return int((time.time() - self.epoch) * tick_rate)
+
+rooms = {} # all rooms in memory, keyed by name
+
+client_rooms = {} # name of the room of each client connected to this worker, keyed by client id
+local_client_counts = Counter() # number of clients connected to this worker, keyed by room name
+
+# clients that negotiate the compact encoding (see protocol.CompactCodec) join the socketio room
+# '<room>/compact' and everyone else joins '<room>/json', so frames can be encoded once per
+# encoding instead of once per client.
+encodings = ['compact', 'json']
+
+# events that are relayed to the room as-is, without going through its owner first
+input_events = ['touch_down', 'touch_move', 'touch_up', 'key_down']
+
+def get_room(name=None):
+    """
+    Returns the room with the given name, creating it if needed.
+    Defaults to the room of the client that sent the current event.
+    """
+    if name is None:
+        name = client_rooms[request.sid]
+    if name not in rooms:
+        rooms[name] = Room(name)
+    return rooms[name]
+
+def is_owner(name):
+    """Whether this worker owns the room with the given name (see on_bus_message)."""
+    return owner_index(name, worker_count) == worker_index
+
+def publish(room, event, data):
+    """Publish an event to the room's owner and to every worker with clients in the room."""
+    bus.publish({'room': room.name, 'event': event, 'data': data})
+
+def on_bus_message(message):
+    """
+    Handles a message from the bus. Each room is owned by one worker (see bus.owner_index), which
+    keeps its state, membership and bubble simulation, and publishes what it decides. Workers with
+    clients in the room relay what's published to those clients. The bus only delivers a room's
+    messages to its owner and to workers with clients in it, in the same order, so no other worker
+    does any work for the room.
+    """
+    name, event, data = message['room'], message['event'], message['data']
+    owner = is_owner(name)
+    if not owner and not local_client_counts[name]:
+        return # the room's last client here left while the message was on its way
+
+    room = get_room(name)
+    room.last_active = time.time()
+    if owner:
+        own_event(room, event, data)
+    if local_client_counts[name]:
+        relay_event(room, event, data)
+
+def own_event(room, event, data):
+    """Applies a message to a room that this worker owns."""
+    if event == 'join':
+        if room.epoch is None:
+            room.physics, room.epoch = data['physics'], data['epoch']
+            if room.physics == 'server':
+                room.simulation = RoomSimulation(room.state_dict, room.get_tick())
+        room.clients.add(data['cid'])
+        room.peer_ids[data['cid']] = room.next_peer_id
+        room.next_peer_id = (room.next_peer_id + 1) % 65536
+        publish_members(room)
+
+        # late joiners are sent every bubble in flight
+        bubbles = room.simulation.all_spawn_info() if room.simulation else []
+        publish(room, 'room_info', {'cid': data['cid'], 'bubbles': bubbles})
+    elif event == 'leave':
+        room.clients.discard(data['cid'])
+        room.clock_reports.pop(data['cid'], None)
+        room.peer_ids.pop(data['cid'], None)
+        publish_members(room)
+    elif event == 'update_state':
+        module_str, deltas, cid, post = data['module'], data['deltas'], data['cid'], data['post']
+        apply_deltas(room.state_dict[module_str], deltas)
+
+        if post:
+            room.version_dict[module_str] += 1
+            send_data = {
+                'cid': cid,
+                'module': module_str,
+                'deltas': deltas,
+                'version': room.version_dict[module_str]
+            }
+            publish(room, 'relay', {'event': 'update_state', 'data': send_data})
+    elif event == 'sync_request':
+        publish(room, 'sync_reply', dict(module_state(room, data), cid=data['cid']))
+    elif event == 'state_hash':
+        check_state_hashes(room, data)
+    elif event == 'clock_report':
+        room.clock_reports[data['cid']] = data
+    elif event in input_events:
+        if room.simulation is not None:
+            room.simulation.on_event(event, data)
+
+def relay_event(room, event, data):
+    """Sends a message to this worker's clients in the room, if it's meant for them."""
+    if event == 'members':
+        # queued events may refer to a leaving client's peer id, so send them first
+        flush_frame(room)
+        room.physics, room.epoch = data['physics'], data['epoch']
+        room.codec.set_peers(data['peer_ids'])
+        socketio.emit('peer_ids', room.codec.peer_ids, room=room.name)
+    elif event == 'room_info':
+        if data['cid'] in client_rooms:
+            room_info = {
+                'physics': room.physics,
+                'epoch': room.epoch,
+                'server_time': time.time(),
+                'bubbles': data['bubbles']
+            }
+            socketio.emit('room_info', room_info, room=data['cid'])
+    elif event == 'relay':
+        queue_event(room, data['event'], data['data'])
+    elif event == 'sync_reply':
+        if data['cid'] in client_rooms:
+            send_data = {key: data[key] for key in ('module', 'state', 'version', 'resync')}
+            socketio.emit('sync_module_state', send_data, room=data['cid'])
+    elif event == 'snapshot_request':
+        room.snapshot_targets |= set(data['targets'])
+        if data['cid'] in client_rooms:
+            socketio.emit('snapshot_request', {'tick': data['tick']}, room=data['cid'])
+    elif event == 'snapshot':
+        # the snapshot goes straight to the desynced clients, rather than waiting for a frame
+        for cid in room.snapshot_targets:
+            if cid in client_rooms:
+                socketio.emit('snapshot', data, room=cid)
+        room.snapshot_targets = set()
+    elif event == 'bubble_snapshot':
+        socketio.emit('bubble_snapshot', data, room=room.name)
+    elif event in input_events:
+        queue_event(room, event, data)
+
+def publish_members(room):
+    """Publish the clients in a room that this worker owns, with the room's physics settings."""
+    data = {'peer_ids': dict(room.peer_ids), 'physics': room.physics, 'epoch': room.epoch}
+    publish(room, 'members', data)
+
+def module_state(room, data):
+    """Returns a module's state in a room that this worker owns, for a sync_module_state request."""
+    module_str = data['module']
+    return {
+        'module': module_str,
+        'state': room.state_dict[module_str],
+        'version': room.version_dict[module_str],
+        'resync': data.get('resync', False)
+    }
+
+def check_state_hashes(room, data):
+    """
+    Records a client's lockstep state hash. Once every client in the room has reported a hash for
+    a tick, clients whose hash differs from the majority's are sent a snapshot of the state from a
+    client in the majority.
+    """
+    tick = data['tick']
+    reports = room.hashes.setdefault(tick, {})
+    reports[data['cid']] = data['hash']
+
+    # ticks that some client never reported (e.g. it left, or joined late) are dropped eventually
+    for old_tick in [t for t in room.hashes if t < tick - 4 * hash_interval]:
+        del room.hashes[old_tick]
+    if not room.clients.issubset(reports):
+        return
+    del room.hashes[tick]
+
+    counts = Counter(reports.values())
+    majority = max(sorted(counts), key=counts.get)
+    desynced = {cid for cid, state_hash in reports.items() if state_hash != majority}
+    if not desynced:
+        return
+
+    reference = min(cid for cid, state_hash in reports.items() if state_hash == majority)
+    publish(room, 'snapshot_request', {'tick': tick, 'cid': reference, 'targets': sorted(desynced)})
+
+def queue_event(room, event, data):
+    room.outbox.append((event, data))
+    if len(room.outbox) >= max_frame_events:
+        flush_frame(room)
+
+def flush_frame(room):
+    """Send every queued event of a room to this worker's clients in one frame per encoding."""
+    if not room.outbox:
+        return
+    events, room.outbox = room.outbox, []
+    if not local_client_counts[room.name]:
+        return
+    room.frame_seq += 1
+    socketio.emit('frame', pack_json_frame(room.frame_seq, events), room=room.name + '/json')
+    packet = room.codec.encode_frame(room.frame_seq, events)
+    socketio.emit('compact_frame', packet, room=room.name + '/compact')
+
+def flush_frames_loop():
+    """Background task that sends every room's queued events once per frame_interval."""
+    while True:
+        for room in list(rooms.values()):
+            flush_frame(room)
+        socketio.sleep(frame_interval)
 
 @app.route('/')
 def test_online():
     return 'server online!'
 
-@app.route('/norms/<cid>')
-def get_norms(cid):
-    return state_dict['norm'].get(cid)
+def drift_report(room):
+    """
+    Returns how far apart the room's clients may hit the same beat, in milliseconds. Each client's
+    clock is within its reported error of the server's, so two clients are at most the sum of their
+    errors apart.
+    """
+    errors = sorted((report['error'] for report in room.clock_reports.values()), reverse=True)
+    return {
+        'clients': {
+            cid: {'error_ms': 1000 * report['error'], 'drift_ppm': report['drift']}
+            for cid, report in room.clock_reports.items()
+        },
+        'max_spread_ms': 1000 * sum(errors[:2])
+    }
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'pid': os.getpid(),
+        'client_count': sum(len(room.clients) for room in rooms.values()),
+        'room_count': len(rooms),
+        'moves_coalesced': moves_coalesced,
+        'drift': {name: drift_report(room) for name, room in rooms.items()}
+    })
 
 @socketio.on('connect')
 def connect():
-    """This function is run every time a new client connects to the server."""
-    global client_count
-    client_count += 1
+    """
+    This function is run every time a new client connects to the server.
+    Clients pick a room with the 'room' query parameter, and rooms are created on demand.
+    Clients that support the compact encoding ask for it with the 'enc' query parameter, and the
+    first client in a room picks its physics mode with the 'physics' query parameter.
+    """
+    name = request.args.get('room', default_room)
+    encoding = request.args.get('enc', 'json')
+    if encoding not in encodings:
+        encoding = 'json'
+    physics = request.args.get('physics', 'local')
+    if physics not in physics_modes:
+        physics = 'local'
+
+    client_rooms[request.sid] = name
+    local_client_counts[name] += 1
+    if local_client_counts[name] == 1 and not is_owner(name):
+        bus.watch(name)
+    join_room(name)
+    join_room(name + '/' + encoding)
+    emit('encoding', {'encoding': encoding, 'modules': module_names})
+    publish(get_room(name), 'join', {'cid': request.sid, 'physics': physics, 'epoch': time.time()})
 
 @socketio.on('disconnect')
 def disconnect():
-    global client_count
-    client_count -= 1
+    room = get_room(client_rooms.pop(request.sid))
+    leave_room(room.name)
+    for encoding in encodings:
+        leave_room(room.name + '/' + encoding)
+    publish(room, 'leave', {'cid': request.sid})
+
+    local_client_counts[room.name] -= 1
+    if not local_client_counts[room.name]:
+        del local_client_counts[room.name]
+        if not is_owner(room.name):
+            bus.unwatch(room.name)
+            del rooms[room.name]
 
 @socketio.on('sync_module_state')
 def sync_module_state(data):
     """
     Syncs the state of a new connection with the server's current state for the given module.
+    Clients also use this to resync (data['resync'] is True) after detecting a gap in versions.
     """
-    global state_dict
-    module_str = data['module']
-    server_state = state_dict[module_str]
-    emit('sync_module_state', {'module': module_str, 'state': server_state})
+    room = get_room()
+    if is_owner(room.name):
+        emit('sync_module_state', module_state(room, data))
+    else:
+        # the owner answers through the bus, after every delta it has relayed so far
+        publish(room, 'sync_request', dict(data, cid=request.sid))
 
 @socketio.on('update_state')
 def update_state(data):
     """
-    Updates the server's state after a module handler updates their state.
-    Optionally relays this updated state to all clients if data['post'] is True.
+    Applies a client's (cid, field, value) state deltas to the server's state.
+    Optionally relays the deltas to all clients if data['post'] is True, bumping the module's
+    version so that clients can detect deltas they missed. See on_bus_message().
     """
-    global state_dict
-    module_str, client_state, cid, post = data['module'], data['state'], data['cid'], data['post']
-    server_state = state_dict[module_str]
-    server_state.update(client_state)
-
-    if post:
-        send_data = {'cid': cid, 'module': module_str, 'state': server_state}
-        emit('update_state', send_data, broadcast=True)
+    publish(get_room(), 'update_state', data)
 
-@socketio.on('update_norm')
-def update_norm(data):
-    global state_dict
-    state_dict['norm'].update(data['norm'])
+def stamp_tick(room, event, data):
+    """
+    Returns touch data stamped with the tick on which it takes effect on the room's physics: bubble
+    releases in lockstep rooms, and touches that release bubbles or draw or delete blocks in rooms
+    that the server simulates.
+    """
+    if room.physics == 'lockstep' and event == 'touch_up' and data['module'] == 'PhysicsBubble':
+        return dict(data, tick=room.get_tick() + lockstep_delay)
+    if room.physics == 'server' and data['module'] in ('PhysicsBubble', 'SoundBlock'):
+        return dict(data, tick=room.get_tick() + server_delay)
+    return data
 
 @socketio.on('touch_down')
 def on_touch_down(data):
-    emit('touch_down', data, broadcast=True)
+    room = get_room()
+    flush_move(room, data['cid'])
+    publish(room, 'touch_down', stamp_tick(room, 'touch_down', data))
 
 @socketio.on('touch_move')
 def on_touch_move(data):
-    emit('touch_move', data, broadcast=True)
+    global moves_coalesced
+    room = get_room()
+    if data['cid'] in room.pending_moves:
+        moves_coalesced += 1
+    room.pending_moves[data['cid']] = data
 
 @socketio.on('touch_up')
 def on_touch_up(data):
-    emit('touch_up', data, broadcast=True)
+    # relay the sender's last move before its release so that ordering is preserved
+    room = get_room()
+    flush_move(room, data['cid'])
+    publish(room, 'touch_up', stamp_tick(room, 'touch_up', data))
+
+def flush_move(room, cid):
+    """Relay the pending touch_move of the given sender, if any."""
+    data = room.pending_moves.pop(cid, None)
+    if data is not None:
+        publish(room, 'touch_move', data)
+
+def flush_moves_loop():
+    """Background task that relays every sender's latest touch_move move_rate times a second."""
+    while True:
+        for room in list(rooms.values()):
+            for cid in list(room.pending_moves):
+                flush_move(room, cid)
+        socketio.sleep(1 / move_rate)
+
+def simulate_rooms_loop():
+    """
+    Background task that advances the bubble simulation of rooms in the 'server' physics mode,
+    publishes the bubbles they released and the collisions they had, and streams snapshot_rate
+    snapshots of their bubbles a second. Rooms without clients are left alone until someone joins,
+    when they catch up (see RoomSimulation.run_to).
+
+    Only a room's owner simulates it, and the workers with clients in the room relay what it
+    publishes, so that the room's clients all see the same bubbles however late the bus delivers
+    their touches.
+    """
+    last_snapshot = 0
+    while True:
+        now = time.time()
+        streaming = now - last_snapshot >= 1 / snapshot_rate
+        for room in list(rooms.values()):
+            if room.simulation is None or not room.clients:
+                continue
+            spawned, hits = room.simulation.run_to(room.get_tick())
+            for info in spawned:
+                publish(room, 'relay', {'event': 'bubble_spawn', 'data': info})
+            for hit in hits:
+                publish(room, 'relay', {'event': 'bubble_hit', 'data': hit})
+            if streaming:
+                publish(room, 'bubble_snapshot', encode_snapshot(*room.simulation.snapshot()))
+        if streaming:
+            last_snapshot = now
+        socketio.sleep(frame_interval)
+
+def evict_rooms_loop():
+    """
+    Background task that evicts rooms that have been empty for longer than room_ttl. Only owners
+    know whether a room is empty, and other workers drop rooms as soon as their last client there
+    leaves (see disconnect).
+    """
+    while True:
+        now = time.time()
+        for name, room in list(rooms.items()):
+            if is_owner(name) and room.is_expired(now):
+                del rooms[name]
+        socketio.sleep(min(room_ttl, 60))
 
 @socketio.on('key_down')
 def on_key_down(data):
-    emit('key_down', data, broadcast=True)
+    publish(get_room(), 'key_down', data)
+
+@socketio.on('clock_ping')
+def on_clock_ping(data):
+    """Answers right away with the times the ping arrived and was answered (see ClockSync)."""
+    arrival = time.time()
+    emit('clock_pong', {'t0': data['t0'], 't1': arrival, 't2': time.time()})
+
+@socketio.on('clock_report')
+def on_clock_report(data):
+    publish(get_room(), 'clock_report', data)
+
+@socketio.on('state_hash')
+def on_state_hash(data):
+    publish(get_room(), 'state_hash', data)
+
+@socketio.on('snapshot')
+def on_snapshot(data):
+    publish(get_room(), 'snapshot', data)
+
+@socketio.on('frame')
+def on_frame(frame):
+    """Handles a client's frame of events (see protocol.pack_json_frame), in order."""
+    seq, events = unpack_json_frame(frame)
+    handle_events(events)
+
+@socketio.on('compact_frame')
+def on_compact_frame(packet):
+    """Unpacks a compactly encoded frame and handles it like its JSON counterpart."""
+    seq, events = get_room().codec.decode_frame(packet)
+    handle_events(events)
+
+def handle_events(events):
+    for event, data in events:
+        if event in frame_events:
+            frame_handlers[event](data)
+
+frame_handlers = {
+    'touch_down': on_touch_down,
+    'touch_move': on_touch_move,
+    'touch_up': on_touch_up,
+    'key_down': on_key_down,
+    'update_state': update_state,
+    'state_hash': on_state_hash,
+    'snapshot': on_snapshot,
+    'clock_report': on_clock_report
+}
 
 
 ###################
 # state variables #
 ###################
 
+# initial state of each module in a new room.
 # we don't sync with hold_shape, hold_point, and hold_line because those objects are not
 # json-serializable and are short-term values anyway.
 PhysicsBubbleState = {
@@ -91,7 +538,8 @@ PhysicsBubbleState = {
     'pitch': {},
     'timbre': {},
     'bounces': {},
-    'gravity': {}
+    'gravity': {},
+    'collide': False
 }
 SoundBlockState = {
     'color': {},
@@ -104,16 +552,61 @@ SoundBlockState = {
 TempoCursorState = {
     'touch_points': {},
     'delete_mode': {},
-    'tempo': 60
+    'tempo_curve': {},
+    'tempo': 60,
+    'tempo_changes': []
 }
 
-state_dict = {
-    'PhysicsBubble': PhysicsBubbleState,
-    'SoundBlock': SoundBlockState,
-    'TempoCursor': TempoCursorState,
-    'norm': {}
-}
+def run_worker(port, bus_url, reuse_port=False, index=0):
+    """
+    Runs one server process.
+    :param port: port to serve on
+    :param bus_url: message bus to share rooms through, see bus.make_bus()
+    :param reuse_port: whether other workers are serving on the same port
+    :param index: index of this worker, from 0 to worker_count - 1
+    """
+    global bus, worker_index
+    bus = make_bus(bus_url, index)
+    worker_index = index
+    bus.subscribe(on_bus_message)
+
+    socketio.start_background_task(bus.listen)
+    socketio.start_background_task(flush_moves_loop)
+    socketio.start_background_task(flush_frames_loop)
+    socketio.start_background_task(evict_rooms_loop)
+    socketio.start_background_task(simulate_rooms_loop)
+
+    if reuse_port:
+        # the kernel spreads incoming connections across every worker listening on the port.
+        # clients connect over websocket only, so each connection stays on a single worker.
+        listener = eventlet.listen(('0.0.0.0', port), reuse_port=True)
+        eventlet.wsgi.server(listener, app, log_output=False)
+    else:
+        socketio.run(app, host='0.0.0.0', port=port, debug=False)
+
+def run_workers(count, port):
+    """Runs count worker processes on one port, sharing rooms through a broker process."""
+    global worker_count
+    worker_count = count
+    if os.path.exists(bus_path):
+        os.remove(bus_path)
+    broker = multiprocessing.Process(target=run_broker, args=(bus_path, count), daemon=True)
+    broker.start()
+    while not os.path.exists(bus_path):
+        time.sleep(0.01)
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(port, 'unix://' + bus_path, True, i))
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
-    socketio.run(app, host='0.0.0.0', port=port, debug=False)
+    if worker_count > 1:
+        run_workers(worker_count, port)
+    else:
+        run_worker(port, os.environ.get('BUS_URL', ''))
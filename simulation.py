@@ -0,0 +1,187 @@
+"""
+Server-side simulation of a room's PhysicsBubbles, for rooms in the 'server' physics mode.
+
+Instead of every client simulating every bubble, the server replays the room's touch events on
+its own BubbleWorld and streams quantized snapshots of bubble positions, which clients interpolate
+between. Clients are told about each bubble once when it's released (or when they join), and about
+each collision as a point in the sandbox, so that they can sound the bubble and flash the block
+under that point.
+
+Positions are in pixels of a full-size (1000x1000) sandbox with its bottom left at the origin, so
+a client's sandbox-relative (u, v) coordinates are these divided by sandbox_size.
+"""
+import numpy as np
+
+from modules.physics import BubbleWorld, BlockGrid, step_size
+from protocol import tick_rate
+
+sandbox_size = 1000
+bubble_radius = 40
+min_block_size = 10 # blocks are only drawn if both sides are longer than this
+
+class SimBlock(object):
+    """The bounds of a SoundBlock, which is all the physics needs of one."""
+    def __init__(self, pos, size):
+        self.pos = np.array(pos, dtype=float)
+        self.size = np.array(size, dtype=float)
+
+    def contains(self, pos):
+        return np.all(pos >= self.pos) and np.all(pos <= self.pos + self.size)
+
+class RoomSimulation(object):
+    """
+    Simulates the bubbles and blocks of one room from its touch events. Touches that change the
+    physics (releasing a bubble, drawing or deleting a block) are stamped by the server with the
+    tick they take effect on, and ones that arrive after that tick take effect right away. Only the
+    room's owner simulates it (see server.on_bus_message), so there's a single outcome.
+    """
+    def __init__(self, state_dict, tick):
+        """
+        :param state_dict: the room's module state, for each client's bubble and block settings
+        :param tick: the room's current tick
+        """
+        self.state_dict = state_dict
+        self.world = BubbleWorld()
+        self.world.lockstep = True
+        self.world.tick = tick
+        self.world.time = tick * step_size
+        self.grid = BlockGrid()
+        self.bounds = (0, 0, sandbox_size, sandbox_size)
+
+        self.hold_points = {} # start of each client's bubble slingshot, keyed by client id
+        self.corners = {} # first and latest corner of each client's block, keyed by client id
+        self.actions = [] # (tick, n, function, args) waiting for their tick, in order
+        self.action_count = 0
+
+        self.bubbles = {} # spawn info of each bubble, keyed by world slot
+        self.next_id = 0
+        self.spawned = [] # spawn info of bubbles released since the last run_to()
+
+    def on_event(self, event, data):
+        """Handles a touch event from the room."""
+        module_str = data.get('module')
+        if event not in ('touch_down', 'touch_move', 'touch_up') or \
+           module_str not in ('PhysicsBubble', 'SoundBlock'):
+            return
+
+        cid = data['cid']
+        pos = np.array(data['pos'], dtype=float) * sandbox_size
+        in_bounds = np.all(pos >= 0) and np.all(pos <= sandbox_size)
+
+        if module_str == 'PhysicsBubble':
+            if event == 'touch_down' and in_bounds:
+                self.hold_points[cid] = pos
+            elif event == 'touch_up' and cid in self.hold_points:
+                self.queue(data['tick'], self.release, (cid, self.hold_points.pop(cid), pos))
+            return
+
+        if event == 'touch_down':
+            self.corners.pop(cid, None)
+            if not in_bounds:
+                return
+            # clicking a block deletes it in delete mode, and otherwise doesn't start a new one
+            clicked = [block for block in self.grid.order if block.contains(pos)]
+            if clicked:
+                if self.state_dict['SoundBlock']['delete_mode'].get(cid):
+                    self.queue(data['tick'], self.remove_block, (clicked[0],))
+            elif not self.state_dict['SoundBlock']['delete_mode'].get(cid):
+                self.corners[cid] = (pos, pos)
+        elif event == 'touch_move' and cid in self.corners and in_bounds:
+            self.corners[cid] = (self.corners[cid][0], pos)
+        elif event == 'touch_up' and cid in self.corners:
+            # like SoundBlockHandler, the block spans the first corner and the last move
+            first, last = self.corners.pop(cid)
+            size = np.abs(last - first)
+            if size[0] > min_block_size and size[1] > min_block_size:
+                block = SimBlock(np.minimum(first, last), size)
+                self.queue(data['tick'], self.grid.insert, (block,))
+
+    def queue(self, tick, function, args):
+        self.actions.append((tick, self.action_count, function, args))
+        self.action_count += 1
+        self.actions.sort(key=lambda action: action[:2])
+
+    def remove_block(self, block):
+        if block in self.grid.order: # it may have been deleted by someone else in the meantime
+            self.grid.remove(block)
+
+    def release(self, cid, hold_point, pos):
+        state = self.state_dict['PhysicsBubble']
+        if cid not in state['pitch']:
+            return # this client hasn't sent its settings yet
+
+        # like PhysicsBubble, the release velocity is twice the slingshot's length
+        vel = 2 * (hold_point - pos)
+        gravity = state['gravity'][cid]
+        slot = self.world.add(pos, vel, bubble_radius, state['bounces'][cid], gravity)
+        self.world.quantize()
+        self.bubbles[slot] = {
+            'id': self.next_id,
+            'tick': self.world.tick,
+            'pitch': state['pitch'][cid],
+            'timbre': state['timbre'][cid],
+            'color': state['color'][cid],
+            'bounces': state['bounces'][cid],
+            'gravity': gravity
+        }
+        self.next_id += 1
+        self.spawned.append(self.spawn_info(slot))
+
+    def run_to(self, tick):
+        """
+        Simulates every tick up to the given one.
+        Returns (spawned, hits): the spawn info of every bubble released along the way (see
+        spawn_info), and every collision as a dict of the bubble's id, the tick at which it
+        happened, and the (u, v) point on the block it hit (None for edges and other bubbles).
+        """
+        self.world.bubble_collisions = self.state_dict['PhysicsBubble']['collide']
+        hits = []
+        while self.world.tick < tick:
+            while self.actions and self.actions[0][0] <= self.world.tick:
+                _, _, function, args = self.actions.pop(0)
+                function(*args)
+
+            # with no bubbles in flight, nothing happens until the next action, so skip ahead to it
+            if not self.bubbles:
+                self.world.tick = min(self.actions[0][0], tick) if self.actions else tick
+                self.world.time = self.world.tick * step_size
+                continue
+
+            for slot, block, time in self.world.substep(self.bounds, self.grid):
+                point = None
+                if block is not None:
+                    # the point on the block closest to the bubble, which is where they touched
+                    closest = np.clip(self.world.pos[slot], block.pos, block.pos + block.size)
+                    point = (closest / sandbox_size).tolist()
+                hits.append({
+                    'id': self.bubbles[slot]['id'],
+                    'tick': float(time * tick_rate),
+                    'point': point
+                })
+
+            # bubbles that are out of bounces are done, and fade away on clients
+            for slot in [slot for slot in self.bubbles if self.world.bounces[slot] <= 0]:
+                self.world.remove(slot)
+                del self.bubbles[slot]
+
+        spawned, self.spawned = self.spawned, []
+        return spawned, hits
+
+    def spawn_info(self, slot):
+        """Returns what clients need to draw a bubble, with its current (u, v) and velocity."""
+        info = dict(self.bubbles[slot])
+        info['pos'] = (self.world.pos[slot] / sandbox_size).tolist()
+        info['vel'] = (self.world.vel[slot] / sandbox_size).tolist()
+        return info
+
+    def all_spawn_info(self):
+        """Returns the spawn info of every bubble in flight, for clients that join late."""
+        return [self.spawn_info(slot) for slot in sorted(self.bubbles)]
+
+    def snapshot(self):
+        """Returns (tick, bubbles), with bubbles as a list of (id, (u, v), bounces)."""
+        bubbles = [
+            (info['id'], self.world.pos[slot] / sandbox_size, int(self.world.bounces[slot]))
+            for slot, info in self.bubbles.items()
+        ]
+        return self.world.tick, bubbles